@@ -1,20 +1,33 @@
 import os
 import sys
 import re
+import csv
+import json
+import time
 import datetime
+import difflib
+import hashlib
+import string
+import urllib
+import StringIO
+import threading
+import multiprocessing
 
 import bleach
 import markdown
 import markdown.extensions
+import markdown.preprocessors
 from markdown.util import etree
 import markdown.util
 
 markdown.util.BLOCK_LEVEL_ELEMENTS = re.compile("(?!)")
 
 import flask
+import flask.sessions
 from flask import Flask, render_template, redirect, url_for, request
 import flask_wtf
 import flask_wtf.csrf
+import flask_wtf.file
 import wtforms
 import flask_login
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -23,17 +36,21 @@ from jinja2 import Markup
 
 import sqlalchemy
 import sqlalchemy.orm
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
 
 _root_dir = os.path.dirname(__file__)
 sys.path.insert(0, _root_dir)
 sys.path.insert(0, os.path.join(_root_dir, "plover"))
 
-from stenowiki import steno, sound
+from stenowiki import steno, sound, fuzzy, prefix, metrics
+from stenowiki.cache import Lazy, LRUCache
 # NB: versioned doesn't work with flask-sqlalchemy
 # see https://github.com/mitsuhiko/flask-sqlalchemy/issues/182
 # so we do it manually
 from stenowiki.history_meta import Versioned, versioned_session
+from stenowiki import history_meta
 
 app = Flask(__name__)
 app.config.from_object('settings')
@@ -42,7 +59,25 @@ flask_wtf.csrf.CsrfProtect(app)
 login_manager = flask_login.LoginManager()
 login_manager.init_app(app)
 
-the_steno = steno.Steno([app.config["DICTIONARY_FILE"]])
+the_steno = steno.Steno(app.config.get("DICTIONARY_FILES", [app.config["DICTIONARY_FILE"]]),
+                        compact=app.config.get("COMPACT_REVERSE_INDEX", False),
+                        snapshot_dir=app.config.get("DICTIONARY_SNAPSHOT_DIR"))
+
+def swap_steno(new_steno):
+    # called from the dictionary watcher once it's reloaded everything
+    global the_steno
+    the_steno = new_steno
+    fuzzy_index.reset()
+    completion_indexes.reset()
+
+if app.config.get("DICTIONARY_RELOAD_INTERVAL"):
+    steno.Watcher(the_steno, swap_steno, app.config["DICTIONARY_RELOAD_INTERVAL"]).start()
+
+@app.before_request
+def pin_steno():
+    # routes use flask.g.steno, so that a request sees the same
+    # dictionaries throughout even if they get reloaded meanwhile
+    flask.g.steno = the_steno
 
 engine = sqlalchemy.create_engine(app.config["SQLALCHEMY_DATABASE_URI"], convert_unicode=True)
 db_session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(autocommit=False,
@@ -53,8 +88,130 @@ Base = sqlalchemy.ext.declarative.declarative_base()
 Base.query = db_session.query_property()
 db = sqlalchemy
 
+class QueryBudgetExceeded(Exception):
+    pass
+
+if app.config.get("QUERY_BUDGET") is not None:
+    # Debugging aid: count the SQL statements each request runs, and
+    # fail the request if it runs more than its budget, so that N+1
+    # query patterns show up in development instead of production.
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if flask.has_request_context():
+            flask.g.query_count = getattr(flask.g, 'query_count', 0) + 1
+
+    @app.after_request
+    def check_query_budget(response):
+        budget = app.config.get("QUERY_BUDGETS", {}).get(request.endpoint, app.config["QUERY_BUDGET"])
+        count = getattr(flask.g, 'query_count', 0)
+        if budget is not None and count > budget:
+            raise QueryBudgetExceeded("%s ran %d queries, but its budget is %d" %
+                                      (request.endpoint, count, budget))
+        return response
+
+if app.config.get("METRICS"):
+    # Request latency, SQL and hot path timings, served from /metrics.
+    # Must come before the functions timed with metrics.timed below.
+    metrics.enable()
+    metrics.instrument(steno.Steno, 'translate', 'steno_translate_seconds',
+                       'Time spent translating strokes')
+    metrics.instrument(steno.Steno, 'reverse_translate', 'steno_reverse_translate_seconds',
+                       'Time spent looking up strokes for words')
+    request_seconds = metrics.histogram('http_request_seconds',
+            'Request latency by endpoint', ('endpoint',))
+    requests_total = metrics.counter('http_requests_total',
+            'Requests by endpoint and status', ('endpoint', 'status'))
+    sql_seconds = metrics.histogram('sql_query_seconds',
+            'SQL statement latency by endpoint', ('endpoint',))
+
+    def metrics_endpoint():
+        return request.endpoint if flask.has_request_context() else None
+
+    @app.before_request
+    def start_timer():
+        flask.g.metrics_start = time.time()
+
+    @app.after_request
+    def record_request(response):
+        start = getattr(flask.g, 'metrics_start', None)
+        if start is not None:
+            request_seconds.observe(time.time() - start, (request.endpoint,))
+        requests_total.inc((request.endpoint, response.status_code))
+        return response
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.time())
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['metrics_start'].pop()
+        sql_seconds.observe(time.time() - start, (metrics_endpoint(),))
+
+    @app.route("/metrics")
+    def metrics_page():
+        return flask.Response(metrics.registry.render(),
+                              mimetype='text/plain; version=0.0.4')
+
 def install():
     Base.metadata.create_all(bind=engine)
+    create_fulltext()
+
+def upgrade():
+    # install() only creates missing tables; this also adds the columns
+    # and indexes which postdate an existing database's tables
+    Base.metadata.create_all(bind=engine)
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for c in table.columns:
+            if c.name not in columns:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                        (table.name, c.name, c.type.compile(dialect=engine.dialect)))
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for i in table.indexes:
+            if i.name not in indexes:
+                i.create(bind=engine)
+    # entries_history used to get copies of these
+    h = Entry.__history_mapper__.local_table
+    indexes = set(i['name'] for i in inspector.get_indexes(h.name))
+    for c in (h.c.misstroke, h.c.derived_stroke):
+        name = 'ix_%s_%s' % (h.name, c.name)
+        if name in indexes:
+            db.Index(name, c).drop(bind=engine)
+    create_fulltext()
+
+def update_by_id(table, rows):
+    # rows are dicts of new values plus the row's '_id'; they're written
+    # with executemany a batch at a time
+    stmt = table.update().where(table.c.id == db.bindparam('_id'))
+    batch = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) == 1000:
+            engine.execute(stmt, batch)
+            batch = []
+    if batch:
+        engine.execute(stmt, batch)
+
+def backfill():
+    # fill in columns derived from other columns (which are normally
+    # maintained on write) for rows that predate them.  NB: read
+    # everything before writing; SQLite won't commit under an open cursor
+    t = Entry.__table__
+    rows = db_session.query(Entry.id, Entry.sound, Entry.is_brief) \
+            .filter(db.or_(Entry.misstroke == None, Entry.desirability == None,
+                           Entry.derived_stroke == None)).all()
+    update_by_id(t, (dict(sound_columns(s, b), _id=id) for id, s, b in rows))
+    rows = db_session.query(Entry.id, Entry.word).filter(Entry.word_key == None).all()
+    update_by_id(t, ({'_id': id, 'word_key': word_key(w)} for id, w in rows))
+    db_session.remove()
+    # and recount word prefixes from scratch
+    c = PrefixCount.__table__
+    first = db.func.substr(t.c.word_key, 1, 1)
+    engine.execute(c.delete())
+    engine.execute(c.insert().from_select(['prefix', 'count'],
+        db.select([first, db.func.count()]).where(t.c.word_key != None).group_by(first)))
 
 class User(Base):
     __tablename__ = 'users'
@@ -151,18 +308,54 @@ def register():
         return redirect(url_for('index'))
     return render_template('register.html', form=form)
 
+class Link(Base):
+    # Backlinks: entry_id's content links to stroke.  Rendered links
+    # embed the sound of (or lack of an entry for) the linked stroke, so
+    # this tells us whose content_html goes stale when a stroke changes.
+    # NB: defined before Entry, since Versioned configures Entry's
+    # mapper (so resolves its relationships) as soon as it's declared
+    __tablename__ = 'links'
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, db.ForeignKey("entries.id"), nullable=False, index=True)
+    stroke = db.Column(db.String(100), nullable=False, index=True)
+
+    def __init__(self, stroke):
+        self.stroke = stroke
+
 class Entry(Versioned, Base):
     __tablename__ = 'entries'
+    # descriptions are mostly unchanged between edits; store old ones as
+    # deltas (see history_meta).  Not content_html: write_rendered
+    # changes it without a new version, so the delta wouldn't apply
+    __history_delta__ = ('content',)
+    __history_snapshot_interval__ = 10
     id = db.Column(db.Integer, primary_key=True)
     stroke = db.Column(db.String(100), unique=True)
     sound = db.Column(db.String(100))
     word = db.Column(db.String(50))
+    # derived from word; see entry_word_set
+    word_key = db.Column(db.String(50))
     content = db.Column(db.Text())
     content_html = db.Column(db.Text())
+    # bumped whenever content_html is re-rendered without an edit (see
+    # write_rendered), so that ETags notice
+    render_count = db.Column(db.Integer())
     is_brief = db.Column(db.Boolean())
+    # derived from sound (and is_brief); see entry_sound_set
+    misstroke = db.Column(db.Boolean())
+    desirability_rank = db.Column('desirability', db.Integer())
+    derived_stroke = db.Column(db.String(100))
+    # in UTC, like entries_history.changed
     timestamp = db.Column(db.DateTime(), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     user = sqlalchemy.orm.relationship("User")
+    links = sqlalchemy.orm.relationship("Link", cascade="all, delete-orphan")
+    # NB: indexes go here rather than on the columns, which history_meta
+    # would copy to entries_history along with the columns
+    __table_args__ = (db.Index('ix_entries_word_key_id', 'word_key', 'id'),
+                      db.Index('ix_entries_word_desirability', 'word', 'desirability'),
+                      db.Index('ix_entries_misstroke', 'misstroke'),
+                      db.Index('ix_entries_derived_stroke', 'derived_stroke'))
 
     def __init__(self, stroke, word, sound):
         self.stroke = stroke
@@ -170,50 +363,207 @@ class Entry(Versioned, Base):
         self.sound = sound
         self.content = ""
         self.content_html = ""
+        self.render_count = 0
         self.is_brief = False
-        self.timestamp = datetime.datetime.now()
+        self.timestamp = datetime.datetime.utcnow()
         self.user_id = None
 
     def is_misstroke(self):
-        return sound.parse(self.sound).is_misstroke()
+        if self.misstroke is None:
+            return sound.parse(self.sound).is_misstroke()
+        return self.misstroke
 
     def desirability(self):
-        if self.is_brief:
-            return 0
-        elif self.is_misstroke():
-            return 2
-        else:
-            return 1
+        if self.desirability_rank is None:
+            return desirability(self.is_brief, self.is_misstroke())
+        return self.desirability_rank
+
+    def render(self):
+        # refresh the cached content_html, and bring our outgoing links
+        # up to date so that rerender_backlinks can find us
+        html, wikilinks = render_markdown(self.content)
+        self.content_html = html.__html__()
+        linked = set(wikilinks)
+        kept = [l for l in self.links if l.stroke in linked]
+        self.links = kept + [Link(s) for s in linked - set(l.stroke for l in kept)]
 
     def __repr__(self):
         return '<Entry %s %s %s _>' % (self.stroke, self.sound, self.word)
 
+def desirability(is_brief, misstroke):
+    # lower sorts first on word pages
+    if is_brief:
+        return 0
+    elif misstroke:
+        return 2
+    else:
+        return 1
+
+def sound_columns(sound_text, is_brief):
+    # the columns derived from an entry's sound, by column key
+    sounds = sound.parse(sound_text or "")
+    misstroke = sounds.is_misstroke()
+    return {'misstroke': misstroke,
+            'desirability': desirability(is_brief, misstroke),
+            'derived_stroke': sounds.stroke()}
+
+@sqlalchemy.event.listens_for(Entry.sound, 'set')
+def entry_sound_set(target, value, oldvalue, initiator):
+    # keep the columns derived from the sound up to date on write, so
+    # readers (e.g. the export, word pages) don't have to parse it
+    c = sound_columns(value, target.is_brief)
+    target.misstroke = c['misstroke']
+    target.desirability_rank = c['desirability']
+    target.derived_stroke = c['derived_stroke']
+
+@sqlalchemy.event.listens_for(Entry.is_brief, 'set')
+def entry_is_brief_set(target, value, oldvalue, initiator):
+    target.desirability_rank = desirability(value, target.is_misstroke())
+
+def word_key(word):
+    # what browse() sorts and pages on: case-folded, so it can use an
+    # index where ILIKE couldn't
+    return word.lower() if word is not None else None
+
+@sqlalchemy.event.listens_for(Entry.word, 'set')
+def entry_word_set(target, value, oldvalue, initiator):
+    target.word_key = word_key(value)
+
+class PrefixCount(Base):
+    # number of entries whose word_key starts with prefix (a single
+    # character), for the alphabet navigation; see count_prefixes
+    __tablename__ = 'word_prefixes'
+    prefix = db.Column(db.String(1), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+@sqlalchemy.event.listens_for(db_session, 'before_flush')
+def count_prefixes(session, flush_context, instances):
+    deltas = {}
+    def bump(key, n):
+        if key:
+            deltas[key[0]] = deltas.get(key[0], 0) + n
+    for obj in session.new:
+        if isinstance(obj, Entry):
+            bump(obj.word_key, 1)
+    for obj in session.dirty:
+        if isinstance(obj, Entry):
+            added, unchanged, deleted = sqlalchemy.orm.attributes.get_history(obj, 'word_key')
+            for k in added: bump(k, 1)
+            for k in deleted: bump(k, -1)
+    for obj in session.deleted:
+        if isinstance(obj, Entry):
+            bump(obj.word_key, -1)
+    c = PrefixCount.__table__
+    for p, n in deltas.iteritems():
+        if n == 0:
+            continue
+        r = session.execute(c.update().where(c.c.prefix == p).values(count=c.c.count + n))
+        if r.rowcount == 0:
+            session.execute(c.insert().values(prefix=p, count=n))
+
+def prefix_counts():
+    return dict(db_session.query(PrefixCount.prefix, PrefixCount.count))
+
+def write_rendered(rows):
+    # Store re-rendered content_html for (id, html) rows.  This isn't
+    # anybody's edit, so it bypasses versioning (no history row, same
+    # version), and bumps render_count instead.
+    t = Entry.__table__
+    stmt = t.update().where(t.c.id == db.bindparam('_id')) \
+            .values(render_count=db.func.coalesce(t.c.render_count, 0) + 1)
+    for batch in batches([{'_id': id, 'content_html': html} for id, html in rows]):
+        db_session.execute(stmt, batch)
+
+def rerender_backlinks(stroke_text):
+    # call after flushing a new entry or a sound change for stroke_text.
+    # The linking entries' content (so their links) are unchanged; only
+    # content_html needs writing, which we do in bulk
+    rows = db_session.query(Entry.id, Entry.content) \
+            .join(Link).filter(Link.stroke == stroke_text).all()
+    write_rendered((id, filter_markdown(c).__html__()) for id, c in rows)
+
+def rerender():
+    # rebuild content_html and the links table for every entry; run
+    # this once after creating the links table on an existing database.
+    # Rendering links needs url_for, so this fakes a request
+    with app.test_request_context():
+        html = []
+        links = []
+        for id, content in db_session.query(Entry.id, Entry.content).all():
+            h, wikilinks = render_markdown(content)
+            html.append((id, h.__html__()))
+            links.extend({'entry_id': id, 'stroke': s} for s in wikilinks)
+        write_rendered(html)
+        db_session.execute(Link.__table__.delete())
+        for batch in batches(links):
+            db_session.execute(Link.__table__.insert(), batch)
+        db_session.commit()
+
+# Rendered sounds, keyed on the sound string (or ('guess', stroke) for
+# guessed sounds).  There are far fewer distinct sounds than page views.
+sound_html_cache = LRUCache(20000, maxbytes=8 * 1024 * 1024)
+sound.on_phonemes_changed(sound_html_cache.clear)
+
+def render_sound(val):
+    html = sound_html_cache.get(val)
+    if html is None:
+        # make sure to call tostring with method='html', otherwise it will
+        # output <span />
+        html = Markup(etree.tostring(sound.parse(val).html(), method='html'))
+        sound_html_cache.put(val, html)
+    return html
+
+def render_guessed_sound(stroke_text):
+    key = ('guess', stroke_text)
+    html = sound_html_cache.get(key)
+    if html is None:
+        html = Markup(etree.tostring(sound.guess_sound(stroke_text).html(), method='html'))
+        sound_html_cache.put(key, html)
+    return html
+
 @app.template_filter('sound')
+@metrics.timed('filter_sound_seconds', 'Time spent rendering sounds')
 def filter_sound(arg):
-    # make sure to call tostring with method='html', otherwise it will
-    # output <span />
-    return Markup(etree.tostring(sound.parse(arg).html(), method='html'))
+    return render_sound(arg)
 
 ALLOWED_TAGS = ('b','i','strong','em','p','div','span','a','ul','ol','li','br','code','del','pre','s','strike','sub','sup','table','tr','td','th')
 
 ALLOWED_ATTRIBUTES = { '*': ['class'], 'a': ['href'] }
 
+WIKILINK_RE = r'\[\[([^\]]+)\]\]'
+
+class WikiLinkPreprocessor(markdown.preprocessors.Preprocessor):
+    # First pass: collect every stroke linked from the document and
+    # resolve them all with a single query, so that WikiLinkPattern
+    # doesn't have to hit the database once per link.
+    def run(self, lines):
+        stroke_texts = set()
+        for m in re.finditer(WIKILINK_RE, '\n'.join(lines)):
+            strokes = steno.normalize(m.group(1))
+            if strokes:
+                stroke_texts.add(strokes.rtfcre)
+        self.markdown.wikilinks = dict.fromkeys(stroke_texts)
+        if stroke_texts:
+            for e in Entry.query.filter(Entry.stroke.in_(stroke_texts)):
+                self.markdown.wikilinks[e.stroke] = e
+        return lines
+
 class WikiLinkPattern(markdown.inlinepatterns.Pattern):
     def handleMatch(self, m):
         val = m.group(2)
         strokes = steno.normalize(val)
         if strokes:
-            stroke_text = '/'.join(map(lambda s: s.rtfcre, strokes))
-            # warning: performance bomb!
-            e = Entry.query.filter_by(stroke=stroke_text).first()
+            stroke_text = strokes.rtfcre
+            e = self.markdown.wikilinks.get(stroke_text)
             attr = {'href': url_for('stroke', value=stroke_text)}
             if e is None:
                 attr['class'] = 'missing'
             el = etree.Element('a', attr)
             if e is None:
-                el.append(sound.guess_sound(stroke_text).html())
+                html = render_guessed_sound(stroke_text)
             else:
-                el.append(sound.parse(e.sound).html())
+                html = render_sound(e.sound)
+            el.text = self.markdown.htmlStash.store(html.__html__())
             return el
         else:
             el = etree.Element('a', {'href': url_for('word', value=val)})
@@ -223,39 +573,386 @@ class WikiLinkPattern(markdown.inlinepatterns.Pattern):
 class SoundPattern(markdown.inlinepatterns.Pattern):
     def handleMatch(self, m):
         val = m.group(2)
-        return sound.parse(val).html()
+        return self.markdown.htmlStash.store(render_sound(val).__html__())
 
 class StenoExtension(markdown.extensions.Extension):
     def extendMarkdown(self, md, md_globals):
-        md.inlinePatterns.add('wikilink', WikiLinkPattern(r'\[\[([^\]]+)\]\]'), '<reference')
-        md.inlinePatterns.add('sound', SoundPattern(r'\{\{([^\}]+)\}\}'), '<reference')
+        md.preprocessors.add('wikilink', WikiLinkPreprocessor(md), '_end')
+        md.inlinePatterns.add('wikilink', WikiLinkPattern(WIKILINK_RE, md), '<reference')
+        md.inlinePatterns.add('sound', SoundPattern(r'\{\{([^\}]+)\}\}', md), '<reference')
+
+# A Markdown instance holds the document it's converting (its
+# htmlStash, and our wikilinks), so threads can't share one
+markdown_local = threading.local()
+
+def steno_markdown():
+    md = getattr(markdown_local, 'md', None)
+    if md is None:
+        md = markdown_local.md = markdown.Markdown(extensions=[StenoExtension()])
+    return md
 
-steno_markdown = markdown.Markdown(extensions=[StenoExtension()])
+@metrics.timed('filter_markdown_seconds', 'Time spent rendering descriptions')
+def render_markdown(text):
+    # returns (html, {stroke: Entry or None}) for every stroke text links to
+    md = steno_markdown()
+    # reset() empties the htmlStash, which would otherwise keep every
+    # rendered link and sound forever.  The preprocessor doesn't run on
+    # blank input, so don't let it see the previous document's links either
+    md.reset()
+    md.wikilinks = {}
+    html = md.convert(text)
+    return Markup(bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES)), md.wikilinks
 
 @app.template_filter('markdown')
 def filter_markdown(arg):
-    html = steno_markdown.convert(arg)
-    return Markup(bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES))
+    return render_markdown(arg)[0]
+
+# Conditional GETs.  Read pages pass not_modified() whatever identifies
+# what they show (entry ids and versions, mostly) before rendering it,
+# and return its 304 if the client's copy is still current.  There's no
+# Last-Modified: pages change without any entry's timestamp moving (on
+# re-renders, dictionary reloads, entries leaving a list), so only the
+# ETag can tell.
+#
+# Pages for logged in users carry their name and CSRF tokens, so aren't
+# cached.  Anonymous pages are public, and don't touch the session (see
+# SessionInterface), so that a shared cache can hand one visitor's copy
+# to the next.  Logging in always sets the remember cookie, so a shared
+# cache in front should pass requests carrying it straight through.
+
+CACHE_MAX_AGE = app.config.get("CACHE_MAX_AGE", 0)
+CACHE_SHARED_MAX_AGE = app.config.get("CACHE_SHARED_MAX_AGE")
+
+class SessionInterface(flask.sessions.SecureCookieSessionInterface):
+    def save_session(self, app, session, response):
+        # public responses mustn't set this visitor's session cookie
+        if response.cache_control.public:
+            return
+        super(SessionInterface, self).save_session(app, session, response)
+
+app.session_interface = SessionInterface()
+
+def not_modified(parts):
+    if request.method != 'GET':
+        return None
+    flask.g.cacheable = True
+    if flask_login.current_user.is_authenticated():
+        return None
+    # the dictionaries' stamps stand in for everything the page got
+    # from the dictionaries
+    flask.g.etag = etag = hashlib.sha1(repr((parts, flask.g.steno.stamps))).hexdigest()
+    if etag in request.if_none_match:
+        return flask.Response(status=304)
+    return None
+
+@app.after_request
+def cache_headers(response):
+    if not getattr(flask.g, 'cacheable', False):
+        return response
+    if getattr(flask.g, 'etag', None) is None:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.set_etag(flask.g.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        if CACHE_SHARED_MAX_AGE is not None:
+            response.cache_control.s_maxage = CACHE_SHARED_MAX_AGE
+    return response
+
+def entry_validators(es):
+    return [(e.id, e.version, e.render_count) for e in es]
 
 @app.route("/")
 def index():
-    es = Entry.query.order_by(Entry.timestamp.desc()).limit(20)
+    es = Entry.query.options(sqlalchemy.orm.joinedload(Entry.user)) \
+            .order_by(Entry.timestamp.desc()).limit(20).all()
+    r = not_modified((entry_validators(es),))
+    if r is not None:
+        return r
     return render_template('index.html', es=es)
 
+@app.route("/api/prefix_counts")
+def api_prefix_counts():
+    # for the alphabet navigation's tooltips.  They're fetched on their
+    # own so that the pages around them don't change with every new entry
+    counts = prefix_counts()
+    r = not_modified(sorted(counts.items()))
+    if r is not None:
+        return r
+    return flask.jsonify(counts=counts)
+
+BROWSE_PAGE_SIZE = 50
+
+def browse_query(prefix):
+    # keys starting with prefix are those in [prefix, successor of prefix),
+    # which is an index range scan
+    key = word_key(prefix)
+    return Entry.query.filter(Entry.word_key >= key,
+                              Entry.word_key < key[:-1] + unichr(ord(key[-1]) + 1))
+
 @app.route("/browse/<string:prefix>")
-def browse(prefix):
-    es = Entry.query.filter(Entry.word.ilike(prefix + '%'))
-    return render_template('browse.html', prefix=prefix, es=es)
+@app.route("/browse/<string:prefix>/<int:after_id>")
+def browse(prefix, after_id=None):
+    q = browse_query(prefix)
+    # keyset pagination: continue after the last (word_key, id) we showed.
+    # Links only carry the id, so that pages have plain paths (which the
+    # static pre-renderer can write out); older links have it as an arg
+    if after_id is None:
+        after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        after = db_session.query(Entry.word_key).filter(Entry.id == after_id).scalar()
+        if after is None:
+            flask.abort(404)
+        q = q.filter(db.or_(Entry.word_key > after,
+                            db.and_(Entry.word_key == after, Entry.id > after_id)))
+    es = q.options(sqlalchemy.orm.joinedload(Entry.user)) \
+            .order_by(Entry.word_key, Entry.id).limit(BROWSE_PAGE_SIZE + 1).all()
+    next_page = None
+    if len(es) > BROWSE_PAGE_SIZE:
+        es = es[:BROWSE_PAGE_SIZE]
+        next_page = url_for("browse", prefix=prefix, after_id=es[-1].id)
+    r = not_modified((entry_validators(es), next_page))
+    if r is not None:
+        return r
+    return render_template('browse.html', prefix=prefix, es=es, next_page=next_page)
+
+# The search indexes below are built on first use rather than at
+# import, since they take a while for a full dictionary.  Afterwards,
+# saving an entry adds to them (see index_entry).
+
+def all_mappings():
+    # (outline, translation) for the dictionaries and the wiki entries
+    for strokes, w in the_steno.iteritems():
+        outline = steno.normalize('/'.join(strokes))
+        if outline is not None:
+            yield outline, w
+    for s, w in db_session.query(Entry.stroke, Entry.word):
+        yield steno.normalize(s), w
+
+def build_fuzzy_index():
+    index = fuzzy.FuzzyIndex()
+    for outline, w in all_mappings():
+        index.add(outline, w)
+    return index
+
+fuzzy_index = Lazy(build_fuzzy_index)
+
+def build_completion_indexes():
+    words = []
+    strokes = []
+    for outline, w in all_mappings():
+        words.append((w.lower(), w))
+        strokes.append((outline.rtfcre, (outline.rtfcre, w)))
+    return prefix.PrefixIndex(words), prefix.PrefixIndex(strokes)
+
+completion_indexes = Lazy(build_completion_indexes)
+
+def index_entry(e):
+    if fuzzy_index.value is not None:
+        fuzzy_index.value.add(steno.normalize(e.stroke), e.word)
+    if completion_indexes.value is not None:
+        words, strokes = completion_indexes.value
+        words.add(e.word.lower(), e.word)
+        strokes.add(e.stroke, (e.stroke, e.word))
+
+def load_overlays():
+    overlays = steno.Overlays()
+    refresh_overlays(overlays)
+    return overlays
+
+def refresh_overlays(overlays):
+    # (re)load the dictionaries uploaded since overlays was last brought
+    # up to date, by this process or any other.  overlays.stamps keeps
+    # the upload time we loaded each dictionary as of
+    with overlays_lock:
+        stamps = dict(db_session.query(Dictionary.id, Dictionary.timestamp))
+        changed = [id for id, t in stamps.iteritems() if overlays.stamps.get(id) != t]
+        if changed:
+            q = db_session.query(Dictionary.id, Dictionary.name, User.username).join(User) \
+                    .filter(Dictionary.id.in_(changed))
+            for id, name, username in q.all():
+                rows = db_session.query(DictionaryEntry.stroke, DictionaryEntry.word) \
+                        .filter(DictionaryEntry.dictionary_id == id)
+                overlays.set(overlay_name(username, name), dict(rows))
+        overlays.stamps = stamps
+        overlays.latest = max(stamps.values() or [None])
+
+overlays_lock = threading.Lock()
+dictionary_overlays = Lazy(load_overlays)
+
+def current_overlays():
+    # one query per request tells us whether anyone has uploaded since
+    overlays = dictionary_overlays.get()
+    if db_session.query(db.func.max(Dictionary.timestamp)).scalar() != overlays.latest:
+        refresh_overlays(overlays)
+    return overlays
+
+def overlay_name(username, dictionary_name):
+    return "%s/%s" % (username, dictionary_name)
+
+def layered_steno():
+    return steno.LayeredDictionary(flask.g.steno, current_overlays())
 
 @app.route("/search")
 def search():
     word = request.args.get('word')
     strokes = steno.normalize(word)
     if strokes is not None:
-        stroke_text = '/'.join(map(lambda s: s.rtfcre, strokes))
+        stroke_text = strokes.rtfcre
         return redirect(url_for("stroke", value=stroke_text))
-    # TODO: if it's not a match do a fuzzy search
-    return redirect(url_for("word", value=word))
+    if flask.g.steno.reverse_translate(word) or Entry.query.filter_by(word=word).first() is not None:
+        return redirect(url_for("word", value=word))
+    index = fuzzy_index.get()
+    stroke_suggestions = [(o.rtfcre, flask.g.steno.translate(o)) for o in index.suggest_strokes(word)]
+    word_suggestions = index.suggest_words(word)
+    return render_template('search.html', word=word,
+            stroke_suggestions=stroke_suggestions, word_suggestions=word_suggestions)
+
+# Full-text search over entries.  On SQLite, entries_fts is an FTS5
+# index of entries (an external content table, so the text isn't stored
+# twice) which triggers keep up to date; elsewhere, or without FTS5, we
+# fall back to LIKE.  Either way results are paged with a keyset cursor.
+
+FULLTEXT_PAGE_SIZE = 20
+# bm25 weights for stroke, word and content: a word match counts most
+FULLTEXT_RANK = "bm25(entries_fts, 2.0, 10.0, 1.0)"
+# snippet() brackets matches with these, since its output isn't escaped
+MATCH_START = u'\x02'
+MATCH_END = u'\x03'
+
+FULLTEXT_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+           stroke, word, content, content='entries', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+           INSERT INTO entries_fts(rowid, stroke, word, content)
+               VALUES (new.id, new.stroke, new.word, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+           INSERT INTO entries_fts(entries_fts, rowid, stroke, word, content)
+               VALUES ('delete', old.id, old.stroke, old.word, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS entries_fts_update
+           AFTER UPDATE OF stroke, word, content ON entries BEGIN
+           INSERT INTO entries_fts(entries_fts, rowid, stroke, word, content)
+               VALUES ('delete', old.id, old.stroke, old.word, old.content);
+           INSERT INTO entries_fts(rowid, stroke, word, content)
+               VALUES (new.id, new.stroke, new.word, new.content);
+       END""",
+]
+
+def create_fulltext():
+    # (re)build the full-text index, if the database can have one
+    if engine.dialect.name != 'sqlite':
+        return
+    try:
+        for ddl in FULLTEXT_DDL:
+            engine.execute(ddl)
+    except sqlalchemy.exc.OperationalError:
+        # SQLite built without FTS5
+        return
+    engine.execute("INSERT INTO entries_fts(entries_fts) VALUES ('rebuild')")
+
+def has_fulltext():
+    if engine.dialect.name != 'sqlite':
+        return False
+    return engine.execute("SELECT 1 FROM sqlite_master WHERE name = 'entries_fts'").first() is not None
+
+fulltext_enabled = Lazy(has_fulltext)
+
+def fulltext_terms(q):
+    return re.findall(r'\w+', q, re.UNICODE)
+
+def highlight(snippet):
+    # escape the snippet, then turn the match markers into tags
+    html = unicode(Markup.escape(snippet))
+    return Markup(html.replace(MATCH_START, u'<mark>').replace(MATCH_END, u'</mark>'))
+
+def fulltext_fts(terms, after, after_id, n):
+    # each term as a quoted string, so query syntax in the input is
+    # inert; the last may be a prefix, as in search as you type
+    match = ' '.join('"%s"' % t for t in terms) + '*'
+    sql = """SELECT e.id, e.stroke, e.word, e.sound, %(rank)s AS rank,
+                    snippet(entries_fts, 2, :start, :end, '...', 16) AS snippet
+             FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid
+             WHERE entries_fts MATCH :match""" % {'rank': FULLTEXT_RANK}
+    params = dict(match=match, start=MATCH_START, end=MATCH_END, n=n)
+    if after is not None and after_id is not None:
+        sql += """ AND (%(rank)s > :after OR (%(rank)s = :after AND e.id > :after_id))""" \
+                % {'rank': FULLTEXT_RANK}
+        params.update(after=after, after_id=after_id)
+    sql += " ORDER BY rank, e.id LIMIT :n"
+    return [dict(id=r.id, stroke=r.stroke, word=r.word, sound=r.sound, rank=r.rank,
+                 snippet=highlight(r.snippet))
+            for r in db_session.execute(db.text(sql), params)]
+
+def like_snippet(content, terms, width=80):
+    # the text around the first term, with every term marked
+    content = content or u''
+    m = re.search('|'.join(re.escape(t) for t in terms), content, re.IGNORECASE | re.UNICODE)
+    start = max(0, m.start() - width // 2) if m else 0
+    text = content[start:start + width]
+    text = re.sub('(%s)' % '|'.join(re.escape(t) for t in terms),
+                  MATCH_START + r'\1' + MATCH_END, text, flags=re.IGNORECASE | re.UNICODE)
+    return highlight((u'...' if start else u'') + text +
+                     (u'...' if start + width < len(content) else u''))
+
+def fulltext_like(terms, after_id, n):
+    # unranked; results in id order
+    q = db_session.query(Entry.id, Entry.stroke, Entry.word, Entry.sound, Entry.content)
+    for t in terms:
+        pattern = '%' + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        # like the FTS5 table, a term can match any of the indexed columns
+        q = q.filter(db.or_(*[c.ilike(pattern, escape='\\')
+                              for c in (Entry.stroke, Entry.word, Entry.content)]))
+    if after_id is not None:
+        q = q.filter(Entry.id > after_id)
+    return [dict(id=r.id, stroke=r.stroke, word=r.word, sound=r.sound, rank=None,
+                 snippet=like_snippet(r.content, terms))
+            for r in q.order_by(Entry.id).limit(n)]
+
+@app.route("/fulltext")
+def fulltext():
+    q = request.args.get('q', '')
+    terms = fulltext_terms(q)
+    after = request.args.get('after', type=float)
+    after_id = request.args.get('after_id', type=int)
+    results = []
+    next_page = None
+    if terms:
+        if fulltext_enabled.get():
+            results = fulltext_fts(terms, after, after_id, FULLTEXT_PAGE_SIZE + 1)
+        else:
+            results = fulltext_like(terms, after_id, FULLTEXT_PAGE_SIZE + 1)
+        if len(results) > FULLTEXT_PAGE_SIZE:
+            results = results[:FULLTEXT_PAGE_SIZE]
+            last = results[-1]
+            next_page = url_for("fulltext", q=q, after_id=last['id'],
+                                after=repr(last['rank']) if last['rank'] is not None else None)
+    return render_template('fulltext.html', q=q, results=results, next_page=next_page)
+
+COMPLETION_LIMIT = 50
+
+def completion_args():
+    q = request.args.get('q', '')
+    try:
+        n = min(int(request.args.get('n', 10)), COMPLETION_LIMIT)
+    except ValueError:
+        n = 10
+    return q, n
+
+@app.route("/api/complete/word")
+def complete_word():
+    q, n = completion_args()
+    words, strokes = completion_indexes.get()
+    return flask.jsonify(query=q, completions=words.complete(q.lower(), n))
+
+@app.route("/api/complete/stroke")
+def complete_stroke():
+    q, n = completion_args()
+    words, strokes = completion_indexes.get()
+    return flask.jsonify(query=q, completions=[
+        {'stroke': s, 'word': w} for s, w in strokes.complete(q.upper(), n)])
 
 @app.route("/add_stroke")
 def add_stroke():
@@ -263,8 +960,8 @@ def add_stroke():
     strokes = steno.normalize(request.args.get('stroke'))
     if strokes is None:
         return "BAD STROKE" # TODO
-    stroke_text = '/'.join(map(lambda s: s.rtfcre, strokes))
-    expected_word = the_steno.translate(strokes)
+    stroke_text = strokes.rtfcre
+    expected_word = flask.g.steno.translate(strokes)
     if word != expected_word:
         return "STROKE DOESN'T MAKE WORD" # TODO
     return redirect(url_for("stroke", value=stroke_text, action="edit"))
@@ -289,46 +986,230 @@ def stroke(value):
     strokes = steno.normalize(value)
     if strokes is None:
         return "ill-formed stroke"
-    stroke_text = '/'.join(map(lambda s: s.rtfcre, strokes))
+    stroke_text = strokes.rtfcre
     if stroke_text != value:
         return redirect(url_for("stroke", value=stroke_text))
     e = Entry.query.filter_by(stroke=stroke_text).first()
     is_default = False
     if e is None:
         # would be better if we could see that steno.translate "failed"
-        e = Entry(stroke_text, the_steno.translate(strokes), str(sound.guess_sound(stroke_text)))
+        e = Entry(stroke_text, flask.g.steno.translate(strokes), str(sound.guess_sound(stroke_text)))
         is_default = True
+    alternates = [(name, w) for name, w in layered_steno().lookup(strokes) if name is not None]
+    r = not_modified((stroke_text, e.id, e.version, e.render_count, alternates))
+    if r is not None:
+        return r
     form = StrokeForm(request.form, obj=e)
     form.stroke = stroke_text # HACK
     if request.method == 'POST' and form.validate():
         if not flask_login.current_user.is_authenticated():
             return "You must be logged in to edit entries"
         if is_default: db_session.add(e)
+        sound_changed = is_default or e.sound != form.sound.data
         e.user_id = flask_login.current_user.id
         e.sound = form.sound.data
         e.content = form.content.data
-        e.word = the_steno.translate(strokes)
+        e.word = flask.g.steno.translate(strokes)
         e.is_brief = form.is_brief.data
-        e.content_html = filter_markdown(e.content).__html__()
+        e.timestamp = datetime.datetime.utcnow()
+        e.render()
+        if sound_changed:
+            # links to this stroke render its sound, so entries
+            # containing them need their content_html refreshed
+            db_session.flush()
+            rerender_backlinks(stroke_text)
         db_session.commit()
+        index_entry(e)
         return redirect(url_for("stroke", value=stroke_text))
     action = request.args.get('action')
     if is_default and flask_login.current_user.is_authenticated(): action = "edit"
-    sound_html = Markup(etree.tostring(sound.parse(e.sound).html(), method='html'))
+    sound_html = render_sound(e.sound)
     return render_template('stroke.html', e=e,
             sound_html=sound_html, is_default=is_default, action=action,
-            phonemes=sound.phonemes.items(), form=form)
+            phonemes=sound.phonemes.items(), form=form, alternates=alternates)
 
 @app.route("/word/<path:value>")
 def word(value):
-    es = list(Entry.query.filter_by(word=value))
-    es.sort(key=lambda s: s.desirability())
+    es = Entry.query.filter_by(word=value) \
+            .order_by(Entry.desirability_rank, Entry.id).all()
+    results = layered_steno().reverse_lookup(value)
+    r = not_modified((entry_validators(es), results))
+    if r is not None:
+        return r
     available = set(map(lambda e: e.stroke, es))
-    results = the_steno.reverse_translate(value)
-    if results is None: results = []
-    other_strokes = filter(lambda s: s not in available, map(lambda s: '/'.join(s), results))
+    other_strokes = [s for name, s in results if name is None and s not in available]
     other_entries = map(lambda s: Entry(s, value, str(sound.guess_sound(s))), other_strokes)
-    return render_template('word.html', word=value, es=es, other_entries=other_entries)
+    user_strokes = [(name, s) for name, s in results if name is not None]
+    return render_template('word.html', word=value, es=es, other_entries=other_entries,
+            user_strokes=user_strokes)
+
+# History.  Each entries_history row holds the values which an edit
+# replaced, so version v of an entry is either its history row
+# (id, v) or, for the latest version, the entry itself.  Version v was
+# saved when version v-1 was replaced, i.e. at the (id, v-1) row's
+# changed; version 1 at the entry's timestamp.
+
+EntryHistory = Entry.__history_mapper__.class_
+
+HISTORY_FIELDS = ('sound', 'word', 'content', 'is_brief', 'user_id')
+HISTORY_PAGE_SIZE = 50
+HISTORY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def entry_version(e, version):
+    if version == e.version:
+        return e
+    h = db_session.query(EntryHistory).get((e.id, version))
+    if h is not None:
+        history_meta.reconstruct(db_session, e, [h])
+    return h
+
+def version_changes(old, new):
+    # field by field differences between two versions (old may be None),
+    # with a line diff for the description
+    changes = []
+    for f in HISTORY_FIELDS:
+        a = getattr(old, f) if old is not None else None
+        b = getattr(new, f)
+        if a == b:
+            continue
+        diff = None
+        if f == 'content':
+            diff = list(difflib.unified_diff((a or '').splitlines(), (b or '').splitlines(),
+                                             lineterm=''))[2:]
+        changes.append(dict(field=f, old=a, new=b, diff=diff))
+    return changes
+
+def usernames(ids):
+    ids = set(i for i in ids if i is not None)
+    if not ids:
+        return {}
+    return dict(db_session.query(User.id, User.username).filter(User.id.in_(ids)))
+
+def entry_history(e, before=None, n=HISTORY_PAGE_SIZE):
+    # versions of e older than before (default: all), newest first; we
+    # fetch one more than we show so the oldest shown still has a diff
+    vs = []
+    if before is None or e.version < before:
+        vs.append(e)
+    q = db_session.query(EntryHistory).filter(EntryHistory.id == e.id)
+    if before is not None:
+        q = q.filter(EntryHistory.version < before)
+    vs.extend(history_meta.reconstruct(db_session, e,
+            q.order_by(EntryHistory.version.desc()).limit(n + 1 - len(vs)).all()))
+    names = usernames(v.user_id for v in vs)
+    result = []
+    for v, prev in zip(vs, vs[1:] + [None])[:n]:
+        if prev is not None and prev.version == v.version - 1:
+            saved = prev.changed
+        elif v.version == 1:
+            # the entry's timestamp, as of version 1
+            saved = v.timestamp
+        else:
+            saved = None
+        if prev is None and v.version != 1:
+            # the previous version is on the next page
+            prev = entry_version(e, v.version - 1)
+        result.append(dict(version=v.version, saved=saved, user=names.get(v.user_id),
+                           sound=v.sound, word=v.word, content=v.content,
+                           is_brief=v.is_brief, changes=version_changes(prev, v)))
+    return result
+
+def history_entry(value):
+    # the entry for a stroke's history pages, or None
+    strokes = steno.normalize(value)
+    if strokes is None:
+        return None
+    return Entry.query.filter_by(stroke=strokes.rtfcre).first()
+
+@app.route("/history/<path:value>")
+def history(value):
+    e = history_entry(value)
+    if e is None:
+        flask.abort(404)
+    before = request.args.get('before', type=int)
+    versions = entry_history(e, before)
+    next_page = None
+    if versions and versions[-1]['version'] > 1:
+        next_page = url_for("history", value=e.stroke, before=versions[-1]['version'])
+    return render_template('history.html', e=e, versions=versions, next_page=next_page)
+
+@app.route("/api/history/<path:value>")
+def api_history(value):
+    e = history_entry(value)
+    if e is None:
+        return flask.jsonify(error="no such entry"), 404
+    versions = entry_history(e, request.args.get('before', type=int))
+    for v in versions:
+        if v['saved'] is not None:
+            v['saved'] = v['saved'].isoformat()
+    return flask.jsonify(stroke=e.stroke, version=e.version, versions=versions)
+
+@app.route("/diff/<path:value>")
+def diff(value):
+    e = history_entry(value)
+    if e is None:
+        flask.abort(404)
+    new_version = request.args.get('to', e.version, type=int)
+    old_version = request.args.get('from', new_version - 1, type=int)
+    old = entry_version(e, old_version)
+    new = entry_version(e, new_version)
+    if new is None:
+        flask.abort(404)
+    return render_template('diff.html', e=e, old_version=old_version, new_version=new_version,
+            changes=version_changes(old, new), names=usernames([getattr(old, 'user_id', None), new.user_id]))
+
+def compact_history():
+    # store existing entries_history in snapshot plus delta form; run
+    # this once after upgrade() has added the delta column
+    ids = [id for id, in db_session.query(Entry.id).all()]
+    for batch in batches(ids, 100):
+        history_meta.compact(db_session, Entry.query.filter(Entry.id.in_(batch)).all())
+        db_session.commit()
+
+def recent_changes(q, time_col, id_col, before, before_id, n):
+    # up to n of q's (id, version saved, stroke, word) rows older than
+    # (before, before_id), newest first, as (time, id, version, stroke, word)
+    if before is not None:
+        q = q.filter(db.or_(time_col < before,
+                            db.and_(time_col == before, id_col < before_id)))
+    q = q.add_columns(time_col).order_by(time_col.desc(), id_col.desc()).limit(n)
+    return [(t, id, v, stroke, word) for id, v, stroke, word, t in q]
+
+@app.route("/recent")
+def recent():
+    # Every saved version, newest first: edits are entries_history rows
+    # (row v was replaced by version v + 1 at changed), and creations
+    # are version 1, which is either a live entry or a history row.
+    # Each kind is an index scan on its own time column, paged on
+    # (time, id), and we merge them.
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    if before is not None and before_id is not None:
+        try:
+            before = datetime.datetime.strptime(before, HISTORY_TIME_FORMAT)
+        except ValueError:
+            flask.abort(400)
+    else:
+        before = None
+    h = EntryHistory
+    n = HISTORY_PAGE_SIZE + 1
+    edits = recent_changes(db_session.query(h.id, h.version + 1, h.stroke, h.word),
+            h.changed, h.id, before, before_id, n)
+    created = recent_changes(db_session.query(h.id, h.version, h.stroke, h.word)
+                                     .filter(h.version == 1),
+            h.timestamp, h.id, before, before_id, n)
+    created_live = recent_changes(db_session.query(Entry.id, Entry.version, Entry.stroke, Entry.word)
+                                          .filter(Entry.version == 1),
+            Entry.timestamp, Entry.id, before, before_id, n)
+    changes = sorted(edits + created + created_live, key=lambda c: c[:2], reverse=True)[:n]
+    next_page = None
+    if len(changes) > HISTORY_PAGE_SIZE:
+        changes = changes[:HISTORY_PAGE_SIZE]
+        t, id = changes[-1][:2]
+        next_page = url_for("recent", before=t.strftime(HISTORY_TIME_FORMAT), before_id=id)
+    changes = [dict(time=t, id=id, version=v, stroke=stroke, word=word)
+               for t, id, v, stroke, word in changes]
+    return render_template('recent.html', changes=changes, next_page=next_page)
 
 @app.route('/preview', methods=('GET', 'POST'))
 def preview():
@@ -337,24 +1218,302 @@ def preview():
         return filter_markdown(request.form['content']).__html__()
     return "POST content=$CONTENT to get rendered HTML"
 
+EXPORT_FORMATS = [('csv', 'CSV'), ('json', 'Plover JSON'), ('rtf', 'RTF/CRE')]
+
 class DownloadForm(flask_wtf.Form):
-    pass
+    format = wtforms.SelectField('Format', choices=EXPORT_FORMATS, default='csv')
+
+def export_rows():
+    # only the columns we export, streamed out of the database a batch
+    # at a time rather than loaded all at once
+    q = db_session.query(Entry.stroke, Entry.sound, Entry.word, Entry.is_brief, Entry.misstroke)
+    return q.order_by(Entry.id).execution_options(stream_results=True).yield_per(1000)
+
+def export_csv():
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["stroke", "sound", "word", "is_brief", "is_misstroke"])
+    yield buf.getvalue()
+    for r in export_rows():
+        buf.seek(0)
+        buf.truncate()
+        if r.misstroke is None:
+            misstroke = sound.parse(r.sound or "").is_misstroke()
+        else:
+            misstroke = r.misstroke
+        writer.writerow([r.stroke.encode('utf-8'), (r.sound or "").encode('utf-8'),
+                         (r.word or "").encode('utf-8'), int(bool(r.is_brief)), int(misstroke)])
+        yield buf.getvalue()
+
+def export_json():
+    yield "{"
+    sep = "\n"
+    for r in export_rows():
+        yield "%s%s: %s" % (sep, json.dumps(r.stroke), json.dumps(r.word or ""))
+        sep = ",\n"
+    yield "\n}\n"
+
+def rtf_escape(text):
+    out = []
+    for c in text:
+        if c in '\\{}':
+            out.append('\\' + c)
+        elif ord(c) > 127:
+            out.append('\\u%d?' % (ord(c) if ord(c) < 32768 else ord(c) - 65536))
+        else:
+            out.append(str(c))
+    return ''.join(out)
+
+def export_rtf():
+    yield "{\\rtf1\\ansi{\\*\\cxrev100}\\cxdict{\\*\\cxsystem StenoWiki}{\\stylesheet{\\s0 Normal;}}\r\n"
+    for r in export_rows():
+        yield "{\\*\\cxs %s}%s\r\n" % (r.stroke, rtf_escape(r.word or ""))
+    yield "}\r\n"
+
+EXPORTERS = {
+    'csv': (export_csv, 'text/csv', 'stenowiki.csv'),
+    'json': (export_json, 'application/json', 'stenowiki.json'),
+    'rtf': (export_rtf, 'application/rtf', 'stenowiki.rtf'),
+}
 
 @app.route('/download', methods=('GET', 'POST'))
 def download():
     form = DownloadForm(request.form)
     if request.method == 'POST' and form.validate():
-        es = Entry.query.all()
-        def generate():
-            yield "stroke,sound,word,is_brief,is_misstroke\n"
-            for e in es:
-                # TODO: this will do poorly if there are commas
-                yield "%s,%s,%s,%d,%d\n" % (e.stroke, e.sound, e.word, e.is_brief, e.is_misstroke())
-        r = flask.Response(generate(), mimetype='text/csv')
-        r.headers['Content-Disposition'] = 'attachment; filename=stenowiki.csv'
+        generate, mimetype, filename = EXPORTERS[form.format.data]
+        # the session is torn down with the request context, so keep it
+        # around until we've finished streaming
+        r = flask.Response(flask.stream_with_context(generate()), mimetype=mimetype)
+        r.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
         return r
     return render_template('download.html', form=form)
 
+class Dictionary(Base):
+    # a user's uploaded Plover dictionary; its mappings are the rows of
+    # dictionary_entries, which double as the snapshot we diff the next
+    # upload against
+    __tablename__ = 'dictionaries'
+    __table_args__ = (db.UniqueConstraint('user_id', 'name'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user = sqlalchemy.orm.relationship("User")
+    # in UTC, like Entry.timestamp
+    timestamp = db.Column(db.DateTime())
+
+class DictionaryEntry(Base):
+    __tablename__ = 'dictionary_entries'
+    dictionary_id = db.Column(db.Integer, db.ForeignKey("dictionaries.id"), primary_key=True)
+    stroke = db.Column(db.String(100), primary_key=True)
+    word = db.Column(db.Text(), nullable=False)
+    __table_args__ = (db.Index('ix_dictionary_entries_stroke', 'stroke'),)
+
+SYNC_BATCH_SIZE = 1000
+
+def batches(rows, n=SYNC_BATCH_SIZE):
+    for i in xrange(0, len(rows), n):
+        yield rows[i:i+n]
+
+def sync_dictionary(dictionary, mapping):
+    """Make the stored entries of dictionary match mapping (normalized
+    stroke -> translation), writing only what changed since the last
+    upload.  Writes go through executemany on the session's connection,
+    so they bypass the ORM and commit with the session."""
+    t = DictionaryEntry.__table__
+    conn = db_session.connection()
+    # NB: fetchall(), since dict() would take a ResultProxy for a mapping
+    old = dict(conn.execute(db.select([t.c.stroke, t.c.word])
+                                .where(t.c.dictionary_id == dictionary.id)).fetchall())
+    inserted = []
+    changed = []
+    for s, w in mapping.iteritems():
+        o = old.pop(s, None)
+        if o is None:
+            inserted.append({'dictionary_id': dictionary.id, 'stroke': s, 'word': w})
+        elif o != w:
+            changed.append({'_dictionary_id': dictionary.id, '_stroke': s, 'word': w})
+    # whatever is left in old wasn't in the upload
+    removed = [{'_dictionary_id': dictionary.id, '_stroke': s} for s in old]
+    key = db.and_(t.c.dictionary_id == db.bindparam('_dictionary_id'),
+                  t.c.stroke == db.bindparam('_stroke'))
+    for batch in batches(inserted):
+        conn.execute(t.insert(), batch)
+    for batch in batches(changed):
+        conn.execute(t.update().where(key).values(word=db.bindparam('word')), batch)
+    for batch in batches(removed):
+        conn.execute(t.delete().where(key), batch)
+    return len(inserted), len(changed), len(removed)
+
+def parse_dictionary(f):
+    # returns (normalized stroke -> translation, [unparseable strokes])
+    try:
+        raw = json.load(f)
+    except ValueError:
+        return None, []
+    if not isinstance(raw, dict):
+        return None, []
+    mapping = {}
+    bad = []
+    for k, v in raw.iteritems():
+        strokes = steno.normalize(k)
+        if strokes is None or not isinstance(v, basestring):
+            bad.append(k)
+        else:
+            mapping[strokes.rtfcre] = v
+    return mapping, bad
+
+class UploadForm(flask_wtf.Form):
+    name = wtforms.TextField('Dictionary name', validators=[wtforms.validators.required()])
+    dictionary = flask_wtf.file.FileField('Plover JSON dictionary',
+            validators=[flask_wtf.file.FileRequired()])
+
+@app.route('/upload', methods=('GET', 'POST'))
+def upload():
+    if not flask_login.current_user.is_authenticated():
+        return "You must be logged in to upload dictionaries"
+    # NB: no request.form here; flask_wtf needs to see request.files too
+    form = UploadForm()
+    result = None
+    if request.method == 'POST' and form.validate():
+        mapping, bad = parse_dictionary(form.dictionary.data)
+        if mapping is None:
+            form.dictionary.errors.append("Not a Plover JSON dictionary")
+            return render_template('upload.html', form=form, result=None)
+        d = Dictionary.query.filter_by(user_id=flask_login.current_user.id,
+                                       name=form.name.data).first()
+        if d is None:
+            d = Dictionary()
+            d.name = form.name.data
+            d.user_id = flask_login.current_user.id
+            db_session.add(d)
+        d.timestamp = datetime.datetime.utcnow()
+        db_session.flush()
+        inserted, changed, removed = sync_dictionary(d, mapping)
+        db_session.commit()
+        result = dict(name=d.name, total=len(mapping), inserted=inserted,
+                      changed=changed, removed=removed, bad=bad)
+    return render_template('upload.html', form=form, result=result)
+
+# Static pre-rendering: write the index, the browse pages and every
+# stroke and word page (for entries and the dictionaries alike) as
+# they'd be served to an anonymous user, as outdir/<path>/index.html,
+# so that any file server can serve them.  Pages are fetched through the
+# test client, across a pool of forked workers.  The manifest keeps each
+# page's ETag, so an incremental rebuild sends it back and only rewrites
+# pages which don't come back 304 (see not_modified); pages which are no
+# longer there get deleted.
+
+PRERENDER_MANIFEST = 'manifest.json'
+
+def prerender_paths():
+    strokes = set()
+    words = set()
+    for outline, w in all_mappings():
+        if outline is not None:
+            strokes.add(outline.rtfcre)
+        if w:
+            words.add(w)
+    with app.test_request_context():
+        yield url_for("index")
+        yield url_for("api_prefix_counts")
+        # as linked from the alphabet navigation
+        for l in string.ascii_lowercase:
+            for p in browse_pages(l):
+                yield p
+        for s in strokes:
+            yield url_for("stroke", value=s)
+        for w in words:
+            yield url_for("word", value=w)
+
+def browse_pages(prefix):
+    # the paths browse() pages prefix's entries at, first page first
+    yield url_for("browse", prefix=prefix)
+    ids = [id for id, in browse_query(prefix).with_entities(Entry.id)
+                                             .order_by(Entry.word_key, Entry.id)]
+    for i in xrange(BROWSE_PAGE_SIZE, len(ids), BROWSE_PAGE_SIZE):
+        yield url_for("browse", prefix=prefix, after_id=ids[i - 1])
+
+def prerender_filename(outdir, path):
+    # or None if path can't be a directory name
+    parts = urllib.unquote(path).split('/')[1:]
+    if parts == ['']:
+        parts = []
+    if any(p in ('', '.', '..') or '\0' in p for p in parts):
+        return None
+    return os.path.join(outdir, *(parts + ['index.html']))
+
+def prerender_init():
+    # forked workers mustn't share the parent's database connections
+    engine.dispose()
+
+def prerender_page(job):
+    outdir, path, etag = job
+    filename = prerender_filename(outdir, path)
+    if filename is None:
+        return path, None
+    headers = {}
+    if etag is not None and os.path.exists(filename):
+        headers['If-None-Match'] = '"%s"' % etag
+    r = app.test_client().get(path, headers=headers)
+    if r.status_code == 304:
+        return path, etag
+    if r.status_code != 200:
+        return path, None
+    if not os.path.isdir(os.path.dirname(filename)):
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            # another worker made it first
+            pass
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(r.data)
+    os.rename(filename + '.tmp', filename)
+    return path, r.get_etag()[0]
+
+def prerender_remove(outdir, path):
+    # delete a page we wrote before, and any directories that empties
+    filename = prerender_filename(outdir, path)
+    if filename is None or not os.path.exists(filename):
+        return
+    os.remove(filename)
+    d = os.path.dirname(filename)
+    while d != outdir and not os.listdir(d):
+        os.rmdir(d)
+        d = os.path.dirname(d)
+
+def prerender(outdir, processes=None, incremental=True):
+    # returns (pages written, pages in total)
+    outdir = os.path.abspath(outdir)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest_file = os.path.join(outdir, PRERENDER_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    etags = manifest if incremental else {}
+    jobs = [(outdir, p, etags.get(p)) for p in prerender_paths()]
+    db_session.remove()
+    engine.dispose()
+    pool = multiprocessing.Pool(processes, initializer=prerender_init)
+    rendered = 0
+    new_manifest = {}
+    try:
+        for path, etag in pool.imap_unordered(prerender_page, jobs, chunksize=100):
+            if etag is not None:
+                new_manifest[path] = etag
+                if etag != etags.get(path):
+                    rendered += 1
+    finally:
+        pool.close()
+        pool.join()
+    for path in manifest:
+        if path not in new_manifest:
+            prerender_remove(outdir, path)
+    with open(manifest_file, 'w') as f:
+        json.dump(new_manifest, f)
+    return rendered, len(jobs)
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
@@ -0,0 +1,67 @@
+import collections
+import threading
+
+class LRUCache(object):
+    """A bounded, thread-safe mapping which evicts the least recently
+    used key once it holds more than maxsize entries, or (if maxbytes is
+    given) once the sizeof its values adds up to more than maxbytes."""
+
+    def __init__(self, maxsize=1024, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.data.pop(key, None)
+            self.data[key] = value
+            if self.maxbytes is not None:
+                if old is not None:
+                    self.bytes -= self.sizeof(old)
+                self.bytes += self.sizeof(value)
+            while len(self.data) > self.maxsize or \
+                    (self.maxbytes is not None and self.bytes > self.maxbytes and self.data):
+                k, v = self.data.popitem(last=False)
+                if self.maxbytes is not None:
+                    self.bytes -= self.sizeof(v)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+class Lazy(object):
+    """A value which is computed on first use, only once, even if several
+    threads ask for it at the same time."""
+
+    def __init__(self, f):
+        self.f = f
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value = self.f()
+        return self.value
+
+    def reset(self):
+        # forget the value, so the next get() recomputes it
+        with self.lock:
+            self.value = None
@@ -0,0 +1,132 @@
+"""Approximate matching of strokes and words, for "did you mean"."""
+
+import heapq
+import itertools
+import threading
+
+from stenowiki import keys
+
+def outline_distance(a, b):
+    # number of keys which differ, stroke by stroke; a stroke present
+    # in only one outline counts all of its keys
+    if len(a) == 1 and len(b) == 1:
+        return bin(a[0] ^ b[0]).count('1')
+    d = 0
+    for x, y in itertools.izip_longest(a, b, fillvalue=0):
+        d += bin(x ^ y).count('1')
+    return d
+
+class BKTree:
+    """Burkhard-Keller tree over a metric, supporting "everything within
+    distance n of x" queries without comparing against every item."""
+
+    def __init__(self, distance):
+        self.distance = distance
+        self.root = None
+
+    def add(self, item):
+        if self.root is None:
+            self.root = (item, {})
+            return
+        node = self.root
+        while True:
+            d = self.distance(item, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = (item, {})
+                return
+            node = child
+
+    def search(self, item, n):
+        # returns [(distance, item)], nearest first
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(item, node[0])
+            if d <= n:
+                results.append((d, node[0]))
+            for k, child in node[1].iteritems():
+                if d - n <= k <= d + n:
+                    stack.append(child)
+        results.sort()
+        return results
+
+def trigrams(word):
+    w = '  ' + word.lower() + ' '
+    return set(w[i:i+3] for i in range(len(w) - 2))
+
+class TrigramIndex:
+    def __init__(self):
+        self.words = set()
+        self.postings = {}
+
+    def add(self, word):
+        if word in self.words:
+            return
+        self.words.add(word)
+        for g in trigrams(word):
+            self.postings.setdefault(g, []).append(word)
+
+    def search(self, word, limit):
+        # rank words by the Jaccard similarity of their trigram sets
+        grams = trigrams(word)
+        shared = {}
+        for g in grams:
+            for w in self.postings.get(g, ()):
+                shared[w] = shared.get(w, 0) + 1
+        def score(w):
+            n = shared[w]
+            return float(n) / (len(grams) + len(w) + 1 - n)
+        return heapq.nlargest(limit, shared, key=score)
+
+def loose_outline(text):
+    # Like keys.parse_outline, but keys out of steno order still get a
+    # bit (the first free one with that letter), so that a near miss can
+    # be matched against real strokes.
+    strokes = []
+    for part in text.split('/'):
+        mask = keys.parse_stroke(part)
+        if mask is None:
+            mask = 0
+            for c in part:
+                if c == '-':
+                    continue
+                for i in keys.POSITIONS.get(c, ()):
+                    if not mask & (1 << i):
+                        mask |= 1 << i
+                        break
+                else:
+                    return None
+        strokes.append(mask)
+    return keys.Outline(strokes)
+
+class FuzzyIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.strokes = BKTree(outline_distance)
+        self.words = TrigramIndex()
+
+    def add(self, outline, word):
+        with self.lock:
+            self.strokes.add(outline)
+            if word:
+                self.words.add(word)
+
+    def suggest_strokes(self, text, limit=10, distance=2):
+        if text != text.upper():
+            return []
+        outline = loose_outline(text)
+        if outline is None:
+            return []
+        with self.lock:
+            results = self.strokes.search(outline, distance)
+        return [o for d, o in results[:limit]]
+
+    def suggest_words(self, text, limit=10):
+        with self.lock:
+            return self.words.search(text, limit)
@@ -1,11 +1,23 @@
-"""Versioned mixin class and other utilities."""
+"""Versioned mixin class and other utilities.
+
+A Versioned class may also set __history_delta__ to a tuple of
+(large, text) column keys.  Their old values are then stored as
+compressed deltas against the next version, except every
+__history_snapshot_interval__th version, which is stored whole; see
+reconstruct() for reading them back and compact() for converting
+existing history.  bulk_update() changes many rows at once, keeping
+history as a flush would."""
 
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import mapper, attributes, object_mapper
+from sqlalchemy.orm import mapper, attributes, object_mapper, class_mapper
 from sqlalchemy.orm.exc import UnmappedColumnError
 from sqlalchemy import Table, Column, ForeignKeyConstraint, Integer, DateTime
+from sqlalchemy import LargeBinary, and_, select, bindparam, func
 from sqlalchemy import event, util
 import datetime
+import difflib
+import json
+import zlib
 from sqlalchemy.orm.properties import RelationshipProperty
 
 
@@ -93,12 +105,21 @@ def _history_mapper(local_mapper):
 
         # "changed" column stores the UTC timestamp of when the
         # history row was created.
-        # This column is optional and can be omitted.
+        # This column is optional and can be omitted.  It's indexed, for
+        # listing recent changes; the primary key (id, version) already
+        # serves a single object's history.
         cols.append(Column(
             'changed', DateTime,
             default=datetime.datetime.utcnow,
+            index=True,
             info=version_meta))
 
+        # "delta" holds the compressed differences for the
+        # __history_delta__ columns, which are then NULL; NULL here
+        # means the row is stored whole
+        if getattr(cls, '__history_delta__', None):
+            cols.append(Column('delta', LargeBinary, info=version_meta))
+
         if super_fks:
             cols.append(ForeignKeyConstraint(*zip(*super_fks)))
 
@@ -238,6 +259,13 @@ def create_version(obj, session, deleted=False):
         return
 
     attr['version'] = obj.version
+    if not deleted and not is_snapshot(obj, obj.version):
+        # the new values are about to become version + 1, which is
+        # what the delta is against
+        new = dict((key, getattr(obj, key)) for key in obj.__history_delta__)
+        attr['delta'] = encode_delta(attr, new)
+        for key in new:
+            attr[key] = None
     hist = history_cls()
     for key, value in attr.items():
         setattr(hist, key, value)
@@ -252,3 +280,203 @@ def versioned_session(session):
             create_version(obj, session)
         for obj in versioned_objects(session.deleted):
             create_version(obj, session, deleted=True)
+
+
+def is_snapshot(obj, version):
+    # whether version of obj's history is stored whole
+    fields = getattr(obj, '__history_delta__', None)
+    if not fields:
+        return True
+    interval = getattr(obj, '__history_snapshot_interval__', 10)
+    return version % interval == 0
+
+
+def _line_delta(old, new):
+    # ops turning new into old: [i, j] copies new's lines i:j, a string
+    # is inserted as is
+    if old is None:
+        return None
+    if new is None:
+        return [old]
+    a = new.splitlines(True)
+    b = old.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+
+def _apply_line_delta(ops, new):
+    if ops is None:
+        return None
+    a = (new or '').splitlines(True)
+    return u''.join(
+        op if isinstance(op, basestring) else u''.join(a[op[0]:op[1]])
+        for op in ops)
+
+
+def encode_delta(old, new):
+    """Compress the differences from dict new back to dict old."""
+    return zlib.compress(json.dumps(
+        dict((key, _line_delta(old[key], new[key])) for key in new)))
+
+
+def decode_delta(delta, new):
+    ops = json.loads(zlib.decompress(delta))
+    return dict((key, _apply_line_delta(ops[key], new[key])) for key in new)
+
+
+def _history_criterion(obj):
+    # picks out obj's history rows
+    history_table = obj.__history_mapper__.local_table
+    obj_mapper = object_mapper(obj)
+    return and_(*[
+        history_table.c[col.key] ==
+        getattr(obj, obj_mapper.get_property_by_column(col).key)
+        for col in obj_mapper.primary_key])
+
+
+def _history_query(session, obj):
+    # all of obj's history rows
+    return session.query(obj.__history_mapper__.class_) \
+        .filter(_history_criterion(obj))
+
+
+def reconstruct(session, obj, rows):
+    """Fill in the delta compressed columns of rows, some of obj's
+    history rows, without marking them modified.  Returns rows."""
+    pending = [r for r in rows if getattr(r, 'delta', None) is not None]
+    if not pending:
+        return rows
+    history_table = obj.__history_mapper__.local_table
+    lo = min(r.version for r in pending)
+    hi = max(r.version for r in pending)
+    # walk down from the nearest whole row above them (or failing that
+    # the live object), applying each delta to the version above it;
+    # these are the same objects as rows
+    top = session.query(func.min(history_table.c.version)) \
+        .filter(_history_criterion(obj),
+                history_table.c.version >= hi,
+                history_table.c.delta == None) \
+        .scalar()
+    chain = _history_query(session, obj) \
+        .filter(history_table.c.version >= lo)
+    if top is not None:
+        chain = chain.filter(history_table.c.version <= top)
+    chain = chain.order_by(history_table.c.version.desc())
+    current = dict((key, getattr(obj, key)) for key in obj.__history_delta__)
+    above = obj.version
+    for row in chain:
+        if row.delta is None:
+            current = dict(
+                (key, getattr(row, key)) for key in obj.__history_delta__)
+        else:
+            assert row.version == above - 1, "gap in delta chain"
+            current = decode_delta(row.delta, current)
+            for key, value in current.items():
+                attributes.set_committed_value(row, key, value)
+        above = row.version
+    return rows
+
+
+def compact(session, objs):
+    """Rewrite the history of objs (live Versioned objects) into
+    snapshot and delta form, e.g. after turning on __history_delta__
+    for a class which already has history.  Call session.commit()
+    afterwards."""
+    for obj in objs:
+        table = obj.__history_mapper__.local_table
+        obj_mapper = object_mapper(obj)
+        rows = _history_query(session, obj) \
+            .order_by(table.c.version.desc()).all()
+        reconstruct(session, obj, rows)
+        keys = obj.__history_delta__
+        new = dict((key, getattr(obj, key)) for key in keys)
+        above = obj.version
+        updates = []
+        for row in rows:
+            old = dict((key, getattr(row, key)) for key in keys)
+            if row.version == above - 1 and \
+                    not is_snapshot(obj, row.version):
+                values = dict((key, None) for key in keys)
+                values['delta'] = encode_delta(old, new)
+            else:
+                values = dict(old)
+                values['delta'] = None
+            where = [table.c.version == row.version]
+            for col in obj_mapper.primary_key:
+                prop = obj_mapper.get_property_by_column(col)
+                where.append(table.c[col.key] == getattr(obj, prop.key))
+            updates.append((and_(*where), values))
+            new = old
+            above = row.version
+        for where, values in updates:
+            session.execute(table.update().where(where).values(**values))
+        # the rows' in-memory values no longer match what's stored
+        for row in rows:
+            session.expire(row)
+
+
+def bulk_update(session, cls, rows, batch_size=500):
+    """Write new column values to many rows of Versioned class cls,
+    recording history as create_version does, in a few statements per
+    batch rather than by loading and flushing each object.
+
+    rows are dicts of column key -> new value, plus the primary key; all
+    must have the same keys.  cls must have a single column primary key
+    and no inheritance.  Unchanged rows are skipped.  Attribute events
+    don't fire, so don't use this for columns which other columns are
+    derived from; objects of cls already in the session are expired."""
+    local_mapper = class_mapper(cls)
+    assert local_mapper.inherits is None
+    table = local_mapper.local_table
+    history_table = cls.__history_mapper__.local_table
+    pk, = table.primary_key
+    delta_keys = getattr(cls, '__history_delta__', None)
+    update = table.update() \
+        .where(pk == bindparam('_pk')) \
+        .values(version=table.c.version + 1)
+    updated = set()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        current = dict(
+            (r[pk.key], r) for r in session.execute(
+                select([table]).where(pk.in_([r[pk.key] for r in batch]))))
+        now = datetime.datetime.utcnow()
+        history = []
+        params = []
+        for r in batch:
+            old = current.get(r[pk.key])
+            if old is None or \
+                    all(old[key] == value for key, value in r.items()):
+                continue
+            h = dict((c.key, old[c.key]) for c in history_table.c
+                     if not _is_versioning_col(c))
+            h['version'] = old['version']
+            h['changed'] = now
+            if delta_keys:
+                h['delta'] = None
+                if not is_snapshot(cls, old['version']):
+                    new = dict((key, r.get(key, old[key]))
+                               for key in delta_keys)
+                    h['delta'] = encode_delta(h, new)
+                    for key in new:
+                        h[key] = None
+            history.append(h)
+            p = dict((key, value) for key, value in r.items()
+                     if key != pk.key)
+            p['_pk'] = r[pk.key]
+            params.append(p)
+            updated.add(r[pk.key])
+        if history:
+            session.execute(history_table.insert(), history)
+            session.execute(update, params)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, cls) and \
+                attributes.instance_state(obj).identity[0] in updated:
+            session.expire(obj)
+    return len(updated)
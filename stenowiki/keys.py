@@ -0,0 +1,108 @@
+"""Steno strokes as integer bitmasks.
+
+A stroke is an int with one bit per key, in steno order, so strokes
+compare, hash and sort as cheaply as ints do.  A multi-stroke outline is
+a tuple of them.  Neither needs plover; steno.to_plover converts when
+the translator wants a plover Stroke."""
+
+import array
+import sys
+
+KEYS = ('#', 'S-', 'T-', 'K-', 'P-', 'W-', 'H-', 'R-', 'A-', 'O-', '*',
+        '-E', '-U', '-F', '-R', '-P', '-B', '-L', '-G', '-T', '-S', '-D', '-Z')
+
+LETTERS = tuple(k.strip('-') for k in KEYS)
+
+# index of the first key which can only be reached by writing "-"
+# (or a vowel) before it
+HYPHEN = KEYS.index('-E')
+FIRST_RIGHT = KEYS.index('-F')
+
+# any of these keys makes the hyphen in the RTF/CRE form redundant
+IMPLICIT_HYPHEN = sum(1 << KEYS.index(k) for k in ('A-', 'O-', '*', '-E', '-U'))
+RIGHT = sum(1 << i for i in range(FIRST_RIGHT, len(KEYS)))
+
+# letter -> key indexes carrying that letter, in steno order.  '#' is
+# deliberately absent: plover renders it as digits, which we don't parse.
+POSITIONS = {}
+for i, l in enumerate(LETTERS):
+    if l != '#':
+        POSITIONS.setdefault(l, []).append(i)
+del i, l
+
+def parse_stroke(text):
+    """Parse one stroke in RTF/CRE notation ("HAT", "-T", "H-T") to a
+    bitmask, or return None if it isn't in steno order.  Letters that
+    appear on both sides of the board go on the left unless steno order
+    forces them right, as usual."""
+    mask = 0
+    pos = 0
+    hyphen = False
+    for c in text:
+        if c == '-':
+            if hyphen or pos > HYPHEN:
+                return None
+            hyphen = True
+            pos = HYPHEN
+            continue
+        for i in POSITIONS.get(c, ()):
+            if i >= pos:
+                break
+        else:
+            return None
+        mask |= 1 << i
+        pos = i + 1
+    return mask
+
+def format_stroke(mask):
+    """The RTF/CRE spelling of a stroke bitmask, as plover writes it."""
+    out = []
+    hyphen = not mask & RIGHT or mask & IMPLICIT_HYPHEN
+    i = 0
+    while mask:
+        if mask & 1:
+            if i >= FIRST_RIGHT and not hyphen:
+                out.append('-')
+                hyphen = True
+            out.append(LETTERS[i])
+        mask >>= 1
+        i += 1
+    return ''.join(out)
+
+def steno_keys(mask):
+    return [KEYS[i] for i in range(len(KEYS)) if mask & (1 << i)]
+
+class Outline(tuple):
+    """A sequence of stroke bitmasks."""
+    __slots__ = ()
+
+    @property
+    def rtfcre(self):
+        return '/'.join(map(format_stroke, self))
+
+    def pack(self):
+        # four big-endian bytes per stroke, so that packed outlines sort
+        # like the outlines themselves; suitable as a database key
+        a = array.array('I', self)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        return a.tostring()
+
+    @classmethod
+    def unpack(cls, data):
+        a = array.array('I')
+        a.fromstring(data)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        return cls(a)
+
+def parse_outline(text):
+    """Parse a "/"-separated outline, or return None if any of its
+    strokes is ill-formed."""
+    strokes = []
+    for s in text.split('/'):
+        mask = parse_stroke(s)
+        if mask is None:
+            return None
+        strokes.append(mask)
+    return Outline(strokes)
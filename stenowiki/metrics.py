@@ -0,0 +1,136 @@
+"""Opt-in timing and counting, exposed in the Prometheus text format.
+
+Nothing here costs anything until enable() is called: timed() hands
+back the function it was given, and instrument() does nothing.  So call
+enable() before defining (or instrumenting) anything you want timed.
+Metrics are per process."""
+
+import bisect
+import functools
+import threading
+import time
+
+# seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = False
+
+def enable():
+    global enabled
+    enabled = True
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, escape(v)) for n, v in pairs)
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, labels=(), n=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, v in values:
+            yield self.name + format_labels(self.labels, labels), v
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [count per bucket (the last for +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            v[0][i] += 1
+            v[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self.values.items())
+        for labels, (counts, total) in values:
+            n = 0
+            for le, count in zip(map(repr, self.buckets) + ['+Inf'], counts):
+                n += count
+                yield self.name + '_bucket' + format_labels(self.labels, labels, [('le', le)]), n
+            yield self.name + '_sum' + format_labels(self.labels, labels), total
+            yield self.name + '_count' + format_labels(self.labels, labels), n
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, cls, name, help, labels=()):
+        # the metric called name, made on first use
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(name, help, labels)
+            return m
+
+    def render(self):
+        out = []
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        for name, m in metrics:
+            out.append('# HELP %s %s' % (name, m.help))
+            out.append('# TYPE %s %s' % (name, m.kind))
+            for sample, v in m.samples():
+                out.append('%s %s' % (sample, repr(v) if isinstance(v, float) else v))
+        return '\n'.join(out) + '\n'
+
+registry = Registry()
+
+def counter(name, help, labels=()):
+    return registry.get(Counter, name, help, labels)
+
+def histogram(name, help, labels=()):
+    return registry.get(Histogram, name, help, labels)
+
+def timed(name, help):
+    """Decorator recording each call's duration in histogram name, if
+    metrics are enabled; otherwise it leaves the function alone."""
+    def decorate(f):
+        if not enabled:
+            return f
+        h = histogram(name, help)
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                h.observe(time.time() - start)
+        return wrapper
+    return decorate
+
+def instrument(cls, method, name, help):
+    # time cls.method, for methods of classes we don't define here
+    if enabled:
+        setattr(cls, method, timed(name, help)(cls.__dict__[method]))
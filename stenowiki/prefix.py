@@ -0,0 +1,36 @@
+"""Sorted-array index answering "which keys start with this prefix"."""
+
+import bisect
+import threading
+
+class PrefixIndex:
+    """Parallel sorted lists of keys and values.  A completion is a
+    binary search for the prefix followed by a scan, so it costs the same
+    however many keys there are."""
+
+    def __init__(self, pairs=()):
+        pairs = sorted(set(pairs))
+        self.keys = [k for k, v in pairs]
+        self.values = [v for k, v in pairs]
+        self.lock = threading.Lock()
+
+    def add(self, key, value):
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+            j = i
+            while j < len(self.keys) and self.keys[j] == key:
+                if self.values[j] == value:
+                    return
+                j += 1
+            self.keys.insert(i, key)
+            self.values.insert(i, value)
+
+    def complete(self, prefix, limit=10):
+        results = []
+        with self.lock:
+            keys = self.keys
+            i = bisect.bisect_left(keys, prefix)
+            while i < len(keys) and len(results) < limit and keys[i].startswith(prefix):
+                results.append(self.values[i])
+                i += 1
+        return results
@@ -3,6 +3,8 @@ import re
 from markdown.util import etree
 import collections
 
+from stenowiki.cache import LRUCache
+
 phonemes = collections.OrderedDict([
         # basic phonemes
         ("s", "S"),
@@ -138,8 +140,28 @@ These should work as pages!
 #
 # Not doing a *proper* grammar so the parser is more robust.
 
+SPLIT_RE = re.compile(r'([ \[\]])')
+
+# One alternation in place of trying each atom's regex in turn; the
+# alternatives are tried in the same order, so the first to match wins
+# just as before.
+ATOM_RE = re.compile(
+        r'!(?P<misstroke>[A-Z*\-]+)'
+        r'|~(?P<custom>[A-Z*\-]*)$'
+        r'|(?P<bang>!?)(?P<phoneme>-?[a-z]+\*?)(?::(?P<stroke>[A-Z*\-]*))?')
+
+parse_cache = LRUCache(10000)
+
 def parse(val):
-    tokens = re.split(r'([ \[\]])', val)
+    # NB: the result is shared between callers, so don't mutate it
+    result = parse_cache.get(val)
+    if result is None:
+        result = _parse(val)
+        parse_cache.put(val, result)
+    return result
+
+def _parse(val):
+    tokens = SPLIT_RE.split(val)
     sounds = []
     in_right = False
     for t in tokens:
@@ -161,45 +183,39 @@ def parse(val):
             in_right = False
             sounds.append(Phoneme("", "/", "slash"))
         else:
-            match = re.match(r'^!([A-Z*\-]+)', t)
-            if match:
-                stroke = match.group(1)
-                attr = 'misstroke'
-                sounds.append(Phoneme("", stroke, attr))
+            match = ATOM_RE.match(t)
+            if match is None:
+                sounds.append(Junk(t))
                 continue
-            match = re.match(r'^~([A-Z*\-]*)$', t)
-            if match:
-                stroke = match.group(1)
-                attr = 'custom'
-                sounds.append(Phoneme("", stroke, attr))
+            if match.group('misstroke') is not None:
+                sounds.append(Phoneme("", match.group('misstroke'), 'misstroke'))
                 continue
-            match = re.match(r'^(!?)(-?[a-z]+\*?)(?::([A-Z*\-]*))?', t)
-            if match:
-                phoneme = match.group(2)
-                # UGHHHH
-                if in_right and phoneme.find('-') != 0:
-                    phoneme = '-' + phoneme
-                if phoneme.find('-') == 0:
-                    in_right = True
-                stroke = match.group(3)
-                if stroke is None:
-                    if phoneme not in phonemes and phoneme.find('-') == 0:
-                        phoneme = phoneme[1:]
-                    if phoneme not in phonemes:
-                        sounds.append(Junk(t))
-                        continue
-                    stroke = phonemes[phoneme]
-                    attr = 'phoneme'
-                else:
-                    if match.group(1) == '!':
-                        attr = 'misstroke'
-                    else:
-                        attr = 'custom'
-                if re.match(r'[AOEU*]', stroke):
-                    in_right = True
-                sounds.append(Phoneme(phoneme, stroke, attr))
+            if match.group('custom') is not None:
+                sounds.append(Phoneme("", match.group('custom'), 'custom'))
+                continue
+            phoneme = match.group('phoneme')
+            # UGHHHH
+            if in_right and phoneme.find('-') != 0:
+                phoneme = '-' + phoneme
+            if phoneme.find('-') == 0:
+                in_right = True
+            stroke = match.group('stroke')
+            if stroke is None:
+                if phoneme not in phonemes and phoneme.find('-') == 0:
+                    phoneme = phoneme[1:]
+                if phoneme not in phonemes:
+                    sounds.append(Junk(t))
+                    continue
+                stroke = phonemes[phoneme]
+                attr = 'phoneme'
             else:
-                sounds.append(Junk(t))
+                if match.group('bang') == '!':
+                    attr = 'misstroke'
+                else:
+                    attr = 'custom'
+            if stroke[:1] in ('A', 'O', 'E', 'U', '*'):
+                in_right = True
+            sounds.append(Phoneme(phoneme, stroke, attr))
     return Sounds(sounds)
 
 class Sounds:
@@ -378,22 +394,78 @@ meanings = [
     { "from": "AO", "to": "oo" },
   ]
 
+def compile_meanings(meanings):
+    # A trie over the "from" strings.  A node's None key holds the
+    # meaning ending there as (priority, length, [(phoneme, stroke)]),
+    # where priority is its index in meanings: when several meanings
+    # match at a position, the one listed first wins.
+    trie = {}
+    for priority, m in enumerate(meanings):
+        node = trie
+        for c in m["from"]:
+            node = node.setdefault(c, {})
+        if not isinstance(m["to"], str):
+            result = [(to, phonemes[to]) for to in m["to"]]
+        else:
+            result = [(m["to"], m["from"])]
+        node.setdefault(None, (priority, len(m["from"]), result))
+    return trie
+
+meanings_trie = compile_meanings(meanings)
+
+phonemes_listeners = []
+
+def on_phonemes_changed(f):
+    # f() will be called whenever phonemes_changed() is
+    phonemes_listeners.append(f)
+    return f
+
+def phonemes_changed():
+    # call after modifying phonemes or meanings, to drop everything
+    # we (and anyone listening) derived from the old tables
+    global meanings_trie
+    meanings_trie = compile_meanings(meanings)
+    parse_cache.clear()
+    guess_cache.clear()
+    for f in phonemes_listeners:
+        f()
+
+guess_cache = LRUCache(10000)
+
 def guess_sound(stroke):
+    # NB: the result is shared between callers, so don't mutate it
+    result = guess_cache.get(stroke)
+    if result is None:
+        result = _guess_sound(stroke)
+        guess_cache.put(stroke, result)
+    return result
+
+def guess_sounds(strokes):
+    # for guessing a whole dictionary at once; bypasses the cache so
+    # we don't flush it
+    return map(_guess_sound, strokes)
+
+def _guess_sound(stroke):
     sounds = []
     i = 0
-    while i < len(stroke):
-        done = False
-        for m in meanings:
-            if stroke.startswith(m["from"], i):
-                if not isinstance(m["to"], str):
-                    for to in m["to"]:
-                        sounds.append(Phoneme(to, phonemes[to], "phoneme"))
-                else:
-                    sounds.append(Phoneme(m["to"], m["from"], "phoneme"))
-                i += len(m["from"])
-                done = True
+    n = len(stroke)
+    while i < n:
+        best = None
+        node = meanings_trie
+        j = i
+        while j < n:
+            node = node.get(stroke[j])
+            if node is None:
                 break
-        if done: continue
+            m = node.get(None)
+            if m is not None and (best is None or m[0] < best[0]):
+                best = m
+            j += 1
+        if best is not None:
+            for to, s in best[2]:
+                sounds.append(Phoneme(to, s, "phoneme"))
+            i += best[1]
+            continue
         if stroke[i] == "*":
             sounds.append(Phoneme("", "*", "asterisk"))
         elif stroke[i] == "-":
@@ -1,38 +1,199 @@
-# for some reason, these imports take a long time. Figure out why.
-import plover.dictionary.base
-import plover.translation
-import plover.formatting
-import plover.steno_dictionary
-
-from plover.exception import InvalidConfigurationError, DictionaryLoaderException
-from plover.steno import Stroke, normalize_steno
+# NB: plover's modules take a long time to import, so we only import
+# them where they're needed; normalizing strokes and serving cached
+# translations shouldn't have to pay for them.
 
+import os
 import re
+import json
+import time
+import Queue
+import hashlib
+import marshal
+import logging
+import threading
+
+from stenowiki.cache import LRUCache
+from stenowiki import keys
 
 class Steno:
-    def __init__(self, files):
-        try:
-            dicts = map(plover.dictionary.base.load_dictionary, files)
-        except DictionaryLoaderException as e:
-            raise InvalidConfigurationError(unicode(e))
-
-        self.translator = plover.translation.Translator()
-        self.translator.get_dictionary().set_dicts(dicts)
-        self.translator.set_min_undo_length(10)
-        self.formatter = plover.formatting.Formatter()
-        self.output = StringOutput()
-        self.formatter.set_output(self.output)
-        self.translator.add_listener(self.formatter.format)
+    def __init__(self, files, pool_size=8, cache_size=10000, compact=False,
+                 snapshot_dir=None, dicts=None, stamps=None):
+        import plover.steno_dictionary
+        from plover.exception import InvalidConfigurationError, DictionaryLoaderException
+        self.files = files
+        self.options = dict(pool_size=pool_size, cache_size=cache_size,
+                            compact=compact, snapshot_dir=snapshot_dir)
+        if dicts is None:
+            # stamp before loading, so that changes made while we're
+            # loading get picked up by the next reload
+            stamps = map(file_stamp, files)
+            try:
+                dicts = [load_dictionary(f, snapshot_dir) for f in files]
+            except DictionaryLoaderException as e:
+                raise InvalidConfigurationError(unicode(e))
+        self.dicts = dicts
+        self.stamps = stamps
+
+        # Translators are stateful, so each translate() call checks one
+        # out of the pool rather than sharing a single one between
+        # threads.  The pool grows on demand up to pool_size idle
+        # translators; all of them share the same dictionaries.
+        self.collection = plover.steno_dictionary.StenoDictionaryCollection()
+        self.collection.set_dicts(self.dicts)
+        self.pool = Queue.Queue(pool_size)
+        self.cache = LRUCache(cache_size)
+        self.reverse_index = ReverseIndex(self.collection, compact=compact)
+
+    def _make_translator(self):
+        import plover.translation
+        import plover.formatting
+        translator = plover.translation.Translator()
+        translator.set_dictionary(self.collection)
+        translator.set_min_undo_length(10)
+        formatter = plover.formatting.Formatter()
+        output = StringOutput()
+        formatter.set_output(output)
+        translator.add_listener(formatter.format)
+        return (translator, formatter, output)
+
+    def reloaded(self):
+        """A new Steno reflecting any changes to our dictionary files since
+        they were loaded, or self if there weren't any.  Unchanged files
+        keep their already loaded dictionaries.  We never modify self, so
+        anyone still using it is unaffected."""
+        stamps = map(file_stamp, self.files)
+        if stamps == self.stamps:
+            return self
+        dicts = list(self.dicts)
+        for i, f in enumerate(self.files):
+            if stamps[i] != self.stamps[i]:
+                dicts[i] = reload_dictionary(f, self.dicts[i], self.options['snapshot_dir'])
+        return Steno(self.files, dicts=dicts, stamps=stamps, **self.options)
+
+    def iteritems(self):
+        return iterate(self.collection)
 
     def reverse_translate(self,val):
-        return self.translator.get_dictionary().reverse_lookup(val)
+        return self.reverse_index.lookup(val)
 
     def translate(self, strokes):
-        self.output.reset()
-        self.translator.clear_state()
-        for s in strokes:
-            self.translator.translate(s)
-        return self.output.get()
+        # strokes is a keys.Outline, so it's its own cache key
+        result = self.cache.get(strokes)
+        if result is None:
+            result = self._translate(strokes)
+            self.cache.put(strokes, result)
+        return result
+
+    def _translate(self, strokes):
+        try:
+            triple = self.pool.get_nowait()
+        except Queue.Empty:
+            triple = self._make_translator()
+        translator, formatter, output = triple
+        try:
+            output.reset()
+            translator.clear_state()
+            for s in strokes:
+                translator.translate(to_plover(s))
+            return output.get()
+        finally:
+            try:
+                self.pool.put_nowait(triple)
+            except Queue.Full:
+                pass
+
+def iterate(collection):
+    # (stroke tuple, translation) for every mapping in effect, skipping
+    # those overridden by an earlier dictionary
+    seen = set() if len(collection.dicts) > 1 else None
+    for d in collection.dicts:
+        for strokes, word in d.iteritems():
+            if seen is not None:
+                if strokes in seen: continue
+                seen.add(strokes)
+            yield strokes, word
+
+# inflections which reverse lookups will build out of a stem stroke
+# and a suffix stroke, when the dictionaries don't list the word itself
+INFLECTIONS = ('s', 'es', 'ed', 'ing', 'er', 'ly')
+
+SUFFIX_RE = re.compile(r'^\{\^([a-z]+)\}$')
+
+class ReverseIndex:
+    """Maps words to the stroke tuples which produce them.  Words which
+    aren't in any dictionary, but are an inflection of one that is (e.g.
+    "making" from "make" and "{^ing}"), map to the stem's strokes followed
+    by the suffix's strokes.
+
+    In compact mode we don't keep our own word table; exact lookups go to
+    the dictionaries' reverse tables, and only a bounded number of
+    inflected lookups are remembered."""
+
+    def __init__(self, collection, compact=False):
+        self.collection = collection
+        self.compact = compact
+        self.words = None if compact else {}
+        self.suffixes = {}
+        for strokes, word in iterate(collection):
+            if self.words is not None:
+                self.words.setdefault(word, []).append(strokes)
+            m = SUFFIX_RE.match(word)
+            if m and m.group(1) in INFLECTIONS:
+                self.suffixes.setdefault(m.group(1), []).append(strokes)
+        self.derived = LRUCache(1000 if compact else 100000)
+
+    def exact(self, word):
+        if self.words is None:
+            return self.collection.reverse_lookup(word)
+        return self.words.get(word, [])
+
+    def lookup(self, word):
+        results = self.exact(word)
+        if results:
+            return results
+        results = self.derived.get(word)
+        if results is None:
+            results = self.derive(word)
+            self.derived.put(word, results)
+        return results
+
+    def derive(self, word):
+        import plover.orthography
+        results = []
+        for suffix, suffix_strokes in self.suffixes.iteritems():
+            # a stem can come from more than one ending (e.g. "test"
+            # from both "ed" and "d" of "tested")
+            for stem in set(stem_candidates(word, suffix)):
+                stem_strokes = self.exact(stem)
+                if not stem_strokes or plover.orthography.add_suffix(stem, suffix) != word:
+                    continue
+                for a in stem_strokes:
+                    for b in suffix_strokes:
+                        results.append(a + b)
+        return results
+
+def stem_candidates(word, suffix):
+    # Possible stems which, with suffix added, might be spelled word.
+    # This undoes the usual English spelling changes (silent e, doubled
+    # consonants, y to i); the caller checks each candidate against
+    # plover's orthography rules, so it's fine to suggest too many.
+    for ending in set([suffix, suffix[1:]]):
+        if not ending or not word.endswith(ending) or len(word) <= len(ending):
+            continue
+        base = word[:-len(ending)]
+        yield base
+        yield base + 'e'
+        yield base + 'le'
+        if len(base) > 1 and base[-1] == base[-2]:
+            yield base[:-1]
+        if base.endswith('i'):
+            yield base[:-1] + 'y'
+        if base.endswith('ie'):
+            yield base[:-2] + 'y'
+        if base.endswith('y'):
+            yield base[:-1] + 'ie'
+        if base.endswith('e'):
+            yield base[:-1]
 
 # you could make this more efficient but whatever
 class StringOutput():
@@ -52,33 +213,162 @@ class StringOutput():
         else:
             return self.buffer
 
-# this is actually a trick to make sure the hyphen is in
-# the right place: otherwise Plover accepts H-AT and produces
-# a stroke with "-A" rather than "A-"
-STROKE_RE = re.compile(r"^(S?T?K?P?W?H?R?(A?O?\*?-?E?U?|-)F?R?P?B?L?G?T?S?D?Z?)(/S?T?K?P?W?H?R?(A?O?\*?-?E?U?|-)F?R?P?B?L?G?T?S?D?Z?)*$")
-
 def normalize(value):
-    if STROKE_RE.match(value) is None:
-        return None
-    return map(stroke, value.split('/'))
-
-def stroke(s):
-    keys = []
-    on_left = True
-    vowels = False
-    for k in s:
-        if k in 'EU*-':
-            on_left = False
-        if k in 'AO':
-            vowels = True
-        elif vowels:
-            on_left = False
-        if k == '-': 
-            continue
-        elif k == '*': 
-            keys.append(k)
-        elif on_left: 
-            keys.append(k + '-')
-        else:
-            keys.append('-' + k)
-    return Stroke(keys)
+    # NB: parse_outline insists on steno order; otherwise Plover accepts
+    # H-AT and produces a stroke with "-A" rather than "A-"
+    return keys.parse_outline(value)
+
+def to_plover(mask):
+    from plover.steno import Stroke
+    return Stroke(keys.steno_keys(mask))
+
+# Bump this whenever the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+def file_stamp(filename):
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+def snapshot_path(filename, snapshot_dir):
+    return os.path.join(snapshot_dir,
+            hashlib.sha1(os.path.abspath(filename)).hexdigest() + '.snapshot')
+
+def write_snapshot(filename, stamp, d, snapshot_dir):
+    # write to a temporary file and rename it into place, so that other
+    # workers never see half a snapshot
+    path = snapshot_path(filename, snapshot_dir)
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        marshal.dump((SNAPSHOT_VERSION,) + stamp, f)
+        marshal.dump(dict(d.iteritems()), f)
+    os.rename(tmp, path)
+
+def load_dictionary(filename, snapshot_dir=None):
+    """Load a plover dictionary.  If snapshot_dir is given, we keep a
+    marshalled copy of the parsed dictionary there, and use that instead
+    of parsing the file again as long as the file is unchanged."""
+    if snapshot_dir is not None:
+        stamp = file_stamp(filename)
+        try:
+            with open(snapshot_path(filename, snapshot_dir), 'rb') as f:
+                if marshal.load(f) == (SNAPSHOT_VERSION,) + stamp:
+                    return make_dictionary(filename, marshal.load(f))
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+    # only now, since this pulls in plover's config and machine
+    # registry, which are the slowest of its imports
+    import plover.dictionary.base
+    d = plover.dictionary.base.load_dictionary(filename)
+    if snapshot_dir is None:
+        return d
+    write_snapshot(filename, stamp, d, snapshot_dir)
+    return d
+
+def reload_dictionary(filename, old, snapshot_dir=None):
+    """Load a new version of a dictionary which we loaded before as old.
+    For JSON dictionaries, entries which are the same as in old are
+    carried over as they are, and only new or changed ones go through
+    plover's stroke normalization."""
+    if not filename.lower().endswith('.json'):
+        return load_dictionary(filename, snapshot_dir)
+    from plover.steno import normalize_steno
+    stamp = file_stamp(filename)
+    with open(filename, 'rb') as f:
+        raw = json.load(f)
+    mapping = {}
+    for k, v in raw.iteritems():
+        strokes = tuple(k.split('/'))
+        if old.get(strokes) != v:
+            strokes = normalize_steno(k)
+        mapping[strokes] = v
+    d = make_dictionary(filename, mapping)
+    if snapshot_dir is not None:
+        write_snapshot(filename, stamp, d, snapshot_dir)
+    return d
+
+def make_dictionary(filename, mapping):
+    import plover.steno_dictionary
+    d = plover.steno_dictionary.StenoDictionary()
+    d.update(mapping)
+    d.set_path(filename)
+    return d
+
+class Watcher(threading.Thread):
+    """Polls the dictionary files of a Steno every interval seconds,
+    and when they change, calls swap() with a reloaded Steno."""
+
+    def __init__(self, steno, swap, interval=5):
+        threading.Thread.__init__(self, name="dictionary watcher")
+        self.daemon = True
+        self.steno = steno
+        self.swap = swap
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                steno = self.steno.reloaded()
+            except Exception:
+                # probably caught the file halfway through being saved;
+                # try again next time
+                logging.getLogger(__name__).exception("reloading dictionaries failed")
+                continue
+            if steno is not self.steno:
+                self.steno = steno
+                self.swap(steno)
+
+class Overlays:
+    """Named dictionaries (normalized stroke text -> translation) layered
+    over a base Steno, e.g. users' uploaded dictionaries.  We keep one
+    reverse table across all of them, so memory grows with the total
+    size of the overlays, not with their number times the base."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.layers = {}
+        self.reverse = {}
+        # for the caller, to tell which versions of its dictionaries
+        # the layers hold
+        self.stamps = {}
+        self.latest = None
+
+    def set(self, name, mapping):
+        # replace (or add) the overlay called name
+        with self.lock:
+            for s, w in self.layers.pop(name, {}).iteritems():
+                self.reverse[w].remove((name, s))
+                if not self.reverse[w]:
+                    del self.reverse[w]
+            self.layers[name] = mapping
+            for s, w in mapping.iteritems():
+                self.reverse.setdefault(w, []).append((name, s))
+
+    def lookup(self, stroke_text):
+        with self.lock:
+            return sorted((name, layer[stroke_text])
+                          for name, layer in self.layers.iteritems()
+                          if stroke_text in layer)
+
+    def reverse_lookup(self, word):
+        with self.lock:
+            return sorted(self.reverse.get(word, ()))
+
+class LayeredDictionary:
+    """A base Steno with Overlays on top.  Cheap to make, so make one
+    per request with whichever Steno the request is using."""
+
+    def __init__(self, base, overlays):
+        self.base = base
+        self.overlays = overlays
+
+    def lookup(self, strokes):
+        # [(layer, translation)] for a keys.Outline; the base dictionary's
+        # translation comes first, with layer None
+        return [(None, self.base.translate(strokes))] + \
+               self.overlays.lookup(strokes.rtfcre)
+
+    def reverse_lookup(self, word):
+        # [(layer, stroke text)] producing word, base dictionary first
+        return [(None, '/'.join(s)) for s in self.base.reverse_translate(word) or ()] + \
+               self.overlays.reverse_lookup(word)
@@ -0,0 +1,67 @@
+"""Tests for stenowiki.history_meta, on a throwaway model.
+
+Run from the top of the tree with python -m unittest discover tests."""
+
+import os
+import sys
+import unittest
+
+import sqlalchemy as db
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from stenowiki import history_meta
+from stenowiki.history_meta import Versioned, versioned_session
+
+Base = declarative_base()
+
+class Page(Versioned, Base):
+    __tablename__ = 'pages'
+    __history_delta__ = ('body',)
+    __history_snapshot_interval__ = 3
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(100))
+    body = db.Column(db.Text())
+
+PageHistory = Page.__history_mapper__.class_
+
+class BulkUpdateTest(unittest.TestCase):
+    def setUp(self):
+        engine = db.create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        versioned_session(self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_bulk_update(self):
+        s = self.session
+        pages = [Page(title=u'p%d' % i, body=u'one\ntwo\n') for i in range(3)]
+        s.add_all(pages)
+        s.commit()
+        bodies = [u'one\ntwo\n']
+        for n in range(4):
+            body = u'one\ntwo\n%d\n' % n
+            rows = [{'id': p.id, 'body': body} for p in pages]
+            # unchanged rows are skipped
+            rows[2]['body'] = u'one\ntwo\n'
+            self.assertEqual(history_meta.bulk_update(s, Page, rows, batch_size=2), 2)
+            bodies.append(body)
+        s.commit()
+        p = s.query(Page).get(pages[0].id)
+        self.assertEqual(p.version, 5)
+        self.assertEqual(p.body, bodies[-1])
+        self.assertEqual(s.query(Page).get(pages[2].id).version, 1)
+        history = s.query(PageHistory).filter(PageHistory.id == p.id) \
+                .order_by(PageHistory.version).all()
+        self.assertEqual([h.version for h in history], [1, 2, 3, 4])
+        # snapshots whole, the rest as deltas
+        self.assertEqual([h.delta is None for h in history], [False, False, True, False])
+        history_meta.reconstruct(s, p, history)
+        self.assertEqual([h.body for h in history], bodies[:-1])
+        self.assertEqual(set(h.title for h in history), set([u'p0']))
+
+if __name__ == '__main__':
+    unittest.main()
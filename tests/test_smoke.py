@@ -0,0 +1,293 @@
+"""Smoke tests: the app imports, and its main pages render.
+
+Run from the top of the tree with python -m unittest discover tests.
+Needs the same dependencies as the app itself (including plover)."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+_root_dir = os.path.join(os.path.dirname(__file__), '..')
+_tmp_dir = tempfile.mkdtemp()
+
+def setUpModule():
+    global app
+    with open(os.path.join(_tmp_dir, 'dict.json'), 'w') as f:
+        json.dump({"KAT": "cat", "HAT": "hat", "TKOG": "dog", "TEFT": "test",
+                   "-D": "{^ed}"}, f)
+    with open(os.path.join(_tmp_dir, 'settings.py'), 'w') as f:
+        f.write('SECRET_KEY = "test"\n')
+        f.write('WTF_CSRF_ENABLED = False\n')
+        f.write('ADMIN_PASSWORD = float("nan")\n')
+        f.write('DICTIONARY_FILE = %r\n' % os.path.join(_tmp_dir, 'dict.json'))
+        f.write('SQLALCHEMY_DATABASE_URI = %r\n' % ('sqlite:///' + os.path.join(_tmp_dir, 'test.db')))
+    sys.path.insert(0, _tmp_dir)
+    sys.path.insert(0, _root_dir)
+    import app
+    app.install()
+    user = app.User()
+    user.username = 'alice'
+    user.password = app.generate_password_hash('secret')
+    app.db_session.add(user)
+    app.db_session.commit()
+
+def tearDownModule():
+    shutil.rmtree(_tmp_dir)
+
+class SmokeTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def get(self, path):
+        r = self.client.get(path)
+        self.assertEqual(r.status_code, 200, path)
+        return r.data
+
+    def test_pages(self):
+        self.get('/')
+        self.get('/browse/c')
+        self.assertIn('cat', self.get('/stroke/KAT'))
+        self.assertIn('KAT', self.get('/word/cat'))
+        self.get('/recent')
+        self.get('/download')
+
+def login(client):
+    r = client.post('/login', data={'username': 'alice', 'password': 'secret'})
+    assert r.status_code == 302
+
+class UploadTest(unittest.TestCase):
+    def upload(self, client, mapping):
+        r = client.post('/upload', data={
+            'name': 'mine',
+            'dictionary': (StringIO(json.dumps(mapping)), 'mine.json')})
+        self.assertEqual(r.status_code, 200)
+        return r.data
+
+    def test_upload(self):
+        client = app.app.test_client()
+        login(client)
+        self.upload(client, {"KAT": "kitty", "PWOG": "bog"})
+        self.upload(client, {"KAT": "kitten", "TPROG": "frog"})
+        rows = dict(app.db_session.query(app.DictionaryEntry.stroke, app.DictionaryEntry.word))
+        self.assertEqual(rows, {"KAT": "kitten", "TPROG": "frog"})
+        self.assertIn('kitten', client.get('/stroke/KAT').data)
+
+    def test_upload_from_another_process(self):
+        client = app.app.test_client()
+        login(client)
+        self.upload(client, {"HAT": "hutch"})
+        self.assertIn('hutch', client.get('/stroke/HAT').data)
+        # as another worker would, leaving this process's overlays alone
+        d = app.Dictionary.query.filter_by(name='mine').one()
+        app.sync_dictionary(d, {"HAT": "hatch"})
+        d.timestamp = app.datetime.datetime.utcnow()
+        app.db_session.commit()
+        self.assertIn('hatch', client.get('/stroke/HAT').data)
+
+class BacklinkTest(unittest.TestCase):
+    def test_rerender_is_not_an_edit(self):
+        client = app.app.test_client()
+        login(client)
+        save(client, 'HAT', 'Rhymes with [[KAT]].')
+        hat = app.Entry.query.filter_by(stroke='HAT').one()
+        self.assertIn('missing', hat.content_html)
+        save(client, 'KAT', 'A cat.')
+        hat = app.Entry.query.filter_by(stroke='HAT').one()
+        self.assertNotIn('missing', hat.content_html)
+        self.assertEqual(hat.version, 1)
+        self.assertEqual(hat.render_count, 1)
+        app.db_session.remove()
+
+    def test_rerender_keeps_history(self):
+        client = app.app.test_client()
+        login(client)
+        # the link's line of HTML is the same in both versions, so
+        # version 1's delta would copy it from the live row
+        save(client, 'KAT/KAT', '[[HAT/HAT]]\n\n    x\n    y')
+        save(client, 'KAT/KAT', '[[HAT/HAT]]\n\n    x\n    z')
+        save(client, 'HAT/HAT', 'Hats.')
+        e = app.Entry.query.filter_by(stroke='KAT/KAT').one()
+        self.assertEqual(e.version, 2)
+        self.assertNotIn('missing', e.content_html)
+        self.assertIn('missing', app.entry_version(e, 1).content_html)
+        app.db_session.remove()
+
+class HistoryDeltaTest(unittest.TestCase):
+    def test_reconstruct(self):
+        client = app.app.test_client()
+        login(client)
+        for i in range(1, 26):
+            save(client, 'TEFT', 'Test, take %d.\nSame as ever.' % i)
+        decodes = []
+        decode_delta = app.history_meta.decode_delta
+        def counting(delta, new):
+            decodes.append(delta)
+            return decode_delta(delta, new)
+        app.history_meta.decode_delta = counting
+        try:
+            e = app.Entry.query.filter_by(stroke='TEFT').one()
+            self.assertEqual(e.version, 25)
+            for v in (1, 2, 9, 10, 11, 24):
+                app.db_session.expire_all()
+                del decodes[:]
+                h = app.entry_version(e, v)
+                self.assertEqual(h.content, 'Test, take %d.\nSame as ever.' % v)
+                # from the nearest snapshot above, not the live entry
+                self.assertLess(len(decodes), e.__history_snapshot_interval__)
+        finally:
+            app.history_meta.decode_delta = decode_delta
+            app.db_session.remove()
+
+class MarkdownTest(unittest.TestCase):
+    def test_stash_does_not_grow(self):
+        with app.app.test_request_context():
+            for i in range(3):
+                html = app.filter_markdown(u'See [[KAT]] and {{k a t}}.')
+            self.assertIn('/stroke/KAT', html)
+            self.assertEqual(app.steno_markdown().htmlStash.html_counter, 2)
+
+    def test_threads_get_their_own_links(self):
+        errors = []
+        def render(stroke):
+            try:
+                with app.app.test_request_context():
+                    for i in range(20):
+                        html, links = app.render_markdown(u'See [[%s]].' % stroke)
+                        if links.keys() != [stroke] or '/stroke/' + stroke not in html:
+                            errors.append((stroke, links.keys()))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                app.db_session.remove()
+        threads = [threading.Thread(target=render, args=(s,)) for s in ('KAT', 'HAT', 'TKOG')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_rerender_outside_a_request(self):
+        client = app.app.test_client()
+        login(client)
+        save(client, 'HAT/-D', 'Like [[TKOG/-D]].')
+        app.rerender()
+        e = app.Entry.query.filter_by(stroke='HAT/-D').one()
+        self.assertEqual([l.stroke for l in e.links], ['TKOG/-D'])
+        app.db_session.remove()
+
+def save(client, stroke, content):
+    r = client.post('/stroke/' + stroke, data={
+        'sound': str(app.sound.guess_sound(stroke)), 'content': content})
+    assert r.status_code == 302, r.data
+
+class HistoryTest(unittest.TestCase):
+    def test_recent_and_history(self):
+        client = app.app.test_client()
+        login(client)
+        save(client, 'TKOG', 'A dog.')
+        self.assertIn('/stroke/TKOG', client.get('/recent').data)
+        save(client, 'TKOG', 'A dog, barking.')
+        recent = client.get('/recent').data
+        self.assertIn('/diff/TKOG?to=2', recent)
+        history = client.get('/history/TKOG').data
+        self.assertIn('Version 2 (current)', history)
+        self.assertIn('changed content', history)
+
+class ReverseLookupTest(unittest.TestCase):
+    def test_inflection_listed_once(self):
+        # "test" is a stem of "tested" for both the "ed" and "d" endings
+        self.assertEqual(app.the_steno.reverse_translate('tested'), [('TEFT', '-D')])
+
+class PrerenderTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.page_size = app.BROWSE_PAGE_SIZE
+
+    def tearDown(self):
+        app.BROWSE_PAGE_SIZE = self.page_size
+        shutil.rmtree(self.outdir)
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.outdir, path, 'index.html'))
+
+    def test_browse_pages_and_stale_files(self):
+        client = app.app.test_client()
+        login(client)
+        save(client, 'KAT', 'a cat')
+        save(client, 'KAT/-D', 'catted')
+        app.BROWSE_PAGE_SIZE = 1
+        app.prerender(self.outdir, processes=1)
+        first = app.Entry.query.filter_by(stroke='KAT').one()
+        self.assertTrue(self.exists('browse/c'))
+        self.assertTrue(self.exists('browse/c/%d' % first.id))
+        self.assertTrue(self.exists('browse/z'))
+        app.BROWSE_PAGE_SIZE = self.page_size
+        app.prerender(self.outdir, processes=1)
+        self.assertTrue(self.exists('browse/c'))
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, 'browse/c/%d' % first.id)))
+
+    def test_new_entry_leaves_other_letters_alone(self):
+        app.prerender(self.outdir, processes=1)
+        client = app.app.test_client()
+        login(client)
+        save(client, 'TKOG/TKOG', 'Two dogs.')
+        rendered, total = app.prerender(self.outdir, processes=1)
+        # the new entry's stroke and word pages, /, d's browse page and
+        # the counts, but none of the other letters
+        self.assertTrue(rendered <= 5, (rendered, total))
+
+class FulltextLikeTest(unittest.TestCase):
+    def test_matches_stroke_and_word(self):
+        client = app.app.test_client()
+        login(client)
+        save(client, 'TKOG/-D', 'barked at')
+        strokes = lambda terms: set(r['stroke'] for r in app.fulltext_like(terms, None, 50))
+        self.assertIn('TKOG/-D', strokes([u'dogged']))
+        self.assertIn('TKOG/-D', strokes([u'tkog/-d', u'barked']))
+        self.assertNotIn('TKOG/-D', strokes([u'dogged', u'meowed']))
+
+class IndexTest(unittest.TestCase):
+    def indexes(self, table):
+        inspector = app.sqlalchemy.inspect(app.engine)
+        return set(i['name'] for i in inspector.get_indexes(table))
+
+    def test_history_has_no_derived_column_indexes(self):
+        self.assertIn('ix_entries_misstroke', self.indexes('entries'))
+        self.assertIn('ix_entries_derived_stroke', self.indexes('entries'))
+        # as created before they moved to __table_args__
+        app.engine.execute('CREATE INDEX ix_entries_history_misstroke ON entries_history (misstroke)')
+        app.upgrade()
+        history = self.indexes('entries_history')
+        self.assertNotIn('ix_entries_history_misstroke', history)
+        self.assertNotIn('ix_entries_history_derived_stroke', history)
+
+class CacheHeadersTest(unittest.TestCase):
+    def test_anonymous_pages_are_shareable(self):
+        for path in ('/', '/stroke/KAT', '/word/cat', '/browse/c'):
+            r = app.app.test_client().get(path)
+            self.assertEqual(r.status_code, 200, path)
+            self.assertTrue(r.cache_control.public, path)
+            self.assertNotIn('Set-Cookie', r.headers, path)
+            self.assertNotIn('cookie', r.vary, path)
+            self.assertIsNone(r.last_modified, path)
+            # only the ETag says whether a copy is still good
+            r2 = app.app.test_client().get(path, headers={'If-None-Match': r.headers['ETag']})
+            self.assertEqual(r2.status_code, 304, path)
+            r2 = app.app.test_client().get(path, headers={
+                'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(r2.status_code, 200, path)
+
+    def test_logged_in_pages_are_private(self):
+        client = app.app.test_client()
+        login(client)
+        r = client.get('/stroke/KAT')
+        self.assertTrue(r.cache_control.private)
+        self.assertIsNone(r.headers.get('ETag'))
+
+if __name__ == '__main__':
+    unittest.main()